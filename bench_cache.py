@@ -0,0 +1,85 @@
+import csv
+import random
+from dns_cache import TTLCache
+from eviction import POLICIES
+# hit ratio of every eviction policy in eviction.py on the same query streams, built from the H1-H4 traces
+#   captured:  the DNS queries in H1-H4_urls.csv in capture order (every name is asked once, so nothing can hit)
+#   reruns:    each host resolving its H*_urls.txt list RUNS times, the four hosts interleaved like in the experiment
+#   zipf+scan: the trace names asked with zipf popularity, mixed with names that are asked exactly once
+# each stream goes through a TTLCache per policy and size, a get_entry miss is followed by a put, like the resolver does
+
+TRACE_FILES = ["H1_urls.csv", "H2_urls.csv", "H3_urls.csv", "H4_urls.csv"]
+URL_FILES = ["H1_urls.txt", "H2_urls.txt", "H3_urls.txt", "H4_urls.txt"]
+CACHE_SIZES = [25, 50, 100, 200, 400] # 400 is CACHE_LIMIT in the servers
+RUNS = 5
+ZIPF_QUERIES = 50000
+ZIPF_S = 1.0
+ONE_HIT_SHARE = 0.3 # share of the zipf stream that are one-hit wonders
+
+def captured(trace_files):
+    rows = []
+    for path in trace_files:
+        with open(path, 'r') as f:
+            for row in csv.DictReader(f):
+                if row["Protocol"] == "DNS" and row["Info"].startswith("Standard query 0x"): # llmnr never reaches the resolver
+                    _, _, _, qtype, name = row["Info"].split()[:5]
+                    rows.append((row["Time"], (name.lower(), qtype)))
+    rows.sort()
+    return [key for _, key in rows]
+
+def read_names(url_files):
+    lists = []
+    for path in url_files:
+        with open(path, 'r') as f:
+            lists.append([line.strip().lower() for line in f if line.strip()])
+    return lists
+
+def reruns(lists, runs):
+    stream = []
+    for _ in range(runs):
+        for i in range(max(len(names) for names in lists)):
+            stream.extend((names[i], "A") for names in lists if i < len(names))
+    return stream
+
+def zipf_scan(lists, n, s, one_hit_share, seed=53):
+    rng = random.Random(seed)
+    names = sorted({name for names in lists for name in names})
+    rng.shuffle(names) # popularity rank has nothing to do with the name
+    cum, total = [], 0.0
+    for rank in range(1, len(names) + 1):
+        total += 1 / rank ** s
+        cum.append(total)
+    stream = []
+    for i in range(n):
+        if rng.random() < one_hit_share:
+            stream.append((f"scan{i}.{rng.choice(names)}", "A"))
+        else:
+            stream.append((rng.choices(names, cum_weights=cum)[0], "A"))
+    return stream
+
+def hit_ratio(stream, size, policy):
+    cache = TTLCache(size, policy=policy)
+    hits = 0
+    for key in stream:
+        if cache.get_entry(key) is not None:
+            hits += 1
+        else:
+            cache.put(key, True, 3600)
+    return hits / len(stream) if stream else 0
+
+if __name__ == "__main__":
+    lists = read_names(URL_FILES)
+    workloads = [
+        ("captured", captured(TRACE_FILES)),
+        ("reruns", reruns(lists, RUNS)),
+        ("zipf+scan", zipf_scan(lists, ZIPF_QUERIES, ZIPF_S, ONE_HIT_SHARE)),
+    ]
+    policies = list(POLICIES)
+    print(f"{'workload':<11}{'queries':>8}{'names':>7}{'size':>6}  " + "".join(f"{p:>11}" for p in policies))
+    for label, stream in workloads:
+        for size in CACHE_SIZES:
+            ratios = [hit_ratio(stream, size, p) for p in policies]
+            best = max(ratios)
+            cells = "".join(f"{r:>10.1%}" + ("*" if r == best and best > 0 else " ") for r in ratios)
+            print(f"{label:<11}{len(stream):>8}{len(set(stream)):>7}{size:>6}  {cells}")
+    print("* best policy for that workload and size")
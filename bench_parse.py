@@ -0,0 +1,64 @@
+import time
+import random
+from dnslib import DNSRecord, EDNS0
+from query_parser import parse_query, MalformedQuery
+# micro-benchmark: query_parser.parse_query vs DNSRecord.parse on the names from the H1-H4 traces
+# the mix is roughly what dig / the stub resolvers send: mostly A, some AAAA, about half with an EDNS OPT record
+
+URL_FILES = ["H1_urls.txt", "H2_urls.txt", "H3_urls.txt", "H4_urls.txt"]
+ROUNDS = 20
+
+def build_queries(url_files):
+    names = []
+    for path in url_files:
+        with open(path, 'r') as f:
+            names.extend(line.strip() for line in f if line.strip())
+    rng = random.Random(53)
+    packets = []
+    for name in names:
+        q = DNSRecord.question(name, "AAAA" if rng.random() < 0.2 else "A")
+        if rng.random() < 0.5:
+            q.add_ar(EDNS0(udp_len=1232))
+        packets.append(q.pack())
+    return packets
+
+def bench(fn, packets, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for p in packets:
+            fn(p)
+    return (time.perf_counter() - start) / (rounds * len(packets))
+
+def check(packets):
+    # fast parser has to agree with dnslib on every packet it accepts
+    fallbacks = 0
+    for p in packets:
+        pq = parse_query(p)
+        if pq is None:
+            fallbacks += 1
+            continue
+        full = DNSRecord.parse(p)
+        assert pq.qname == str(full.q.qname).rstrip('.') and pq.qtype == full.q.qtype and pq.txid == full.header.id
+    return fallbacks
+
+def check_malformed(packets):
+    # chopped packets must raise MalformedQuery (or fall back), never anything else
+    errors = 0
+    for p in packets[:200]:
+        for cut in range(len(p)):
+            try:
+                parse_query(p[:cut])
+            except MalformedQuery:
+                errors += 1
+    return errors
+
+if __name__ == "__main__":
+    packets = build_queries(URL_FILES)
+    fallbacks = check(packets)
+    rejected = check_malformed(packets)
+    fast = bench(parse_query, packets, ROUNDS)
+    full = bench(DNSRecord.parse, packets, ROUNDS)
+    print(f"{len(packets)} queries, {fallbacks} needed the full parse, {rejected} truncated packets rejected")
+    print(f"parse_query:     {fast * 1e6:.2f} us/packet")
+    print(f"DNSRecord.parse: {full * 1e6:.2f} us/packet")
+    print(f"speedup: {full / fast:.1f}x")
@@ -0,0 +1,82 @@
+import threading
+import time
+from dnslib import DNSRecord, RR, QTYPE, A, NS
+from resolver import Resolver
+# concurrency check for glueless referrals, against a fake upstream inside this process (no network, no root servers)
+# glue1.com and glue2.com are both delegated to ns.hoster.com without glue, and a client asks for ns.hoster.com itself
+# at the same time, so the sub-walks for the ns name race the client's own walk of it through the single-flight
+# hoster.com is glueless as well (ns.provider.com), so each of those walks starts a nested sub-walk of its own
+# every name has to resolve before DEADLINE, a hang means a walk is waiting on itself somewhere
+#
+#   python check_glueless.py
+
+ROOT, TLD, HOSTER, PROVIDER = "10.53.0.1", "10.53.0.2", "10.53.0.3", "10.53.0.4"
+ANSWER = "192.0.2.53"
+DELAY = 0.05 # seconds every fake server takes to answer, long enough for the walks to overlap
+DEADLINE = 5 # below the resolver's NS_TIMEOUT, so a deadlock broken by that timeout still counts as a hang
+ROUNDS = 20
+NAMES = ["www.glue1.com", "www.glue2.com", "ns.hoster.com"]
+
+def fake_answer(server, qname, qtype):
+    r = DNSRecord.question(qname, qtype).reply()
+    if server == ROOT:
+        r.add_auth(RR("com.", QTYPE.NS, rdata=NS("a.gtld.com."), ttl=3600))
+        r.add_ar(RR("a.gtld.com.", QTYPE.A, rdata=A(TLD), ttl=3600))
+    elif server == TLD and qname.endswith("provider.com"): # in-zone ns name, so this one comes with glue
+        r.add_auth(RR("provider.com.", QTYPE.NS, rdata=NS("ns.provider.com."), ttl=3600))
+        r.add_ar(RR("ns.provider.com.", QTYPE.A, rdata=A(PROVIDER), ttl=3600))
+    elif server == TLD and qname.endswith("hoster.com"):
+        r.add_auth(RR("hoster.com.", QTYPE.NS, rdata=NS("ns.provider.com."), ttl=3600))
+    elif server == TLD: # glue1.com, glue2.com, ...
+        zone = ".".join(qname.split(".")[-2:]) + "."
+        r.add_auth(RR(zone, QTYPE.NS, rdata=NS("ns.hoster.com."), ttl=3600))
+    else:
+        r.header.aa = 1
+        addresses = {"ns.provider.com": PROVIDER, "ns.hoster.com": HOSTER}
+        r.add_answer(RR(qname, QTYPE.A, rdata=A(addresses.get(qname, ANSWER)), ttl=3600))
+    return r
+
+class FakeUpstream: # the part of UpstreamPool that Resolver.ask_servers uses
+    edns_size = 0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_key = 0
+
+    def send(self, qname, server_ip, results, port=53, qtype="A", edns=True):
+        with self.lock:
+            self.next_key += 1
+            key = self.next_key
+        resp = fake_answer(server_ip, qname.rstrip('.').lower(), qtype)
+        threading.Timer(DELAY, results.put, args=((key, resp, DELAY),)).start()
+        return key
+
+    def cancel(self, key):
+        pass
+
+def run_round():
+    engine = Resolver([ROOT], upstream=FakeUpstream())
+    results = {}
+    def resolve(name):
+        results[name] = engine.resolve(name)[0]
+    threads = [threading.Thread(target=resolve, args=(name,), daemon=True) for name in NAMES]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + DEADLINE
+    for t in threads:
+        t.join(max(deadline - time.monotonic(), 0))
+    return {name: [str(rr.rdata) for rr in results[name]] if name in results else None for name in NAMES}
+
+if __name__ == "__main__":
+    failed = 0
+    for i in range(ROUNDS):
+        start = time.perf_counter()
+        got = run_round()
+        hung = [name for name, ips in got.items() if ips is None]
+        empty = [name for name, ips in got.items() if ips == []]
+        status = "HUNG " + ",".join(hung) if hung else ("FAILED " + ",".join(empty) if empty else "ok")
+        failed += status != "ok"
+        print(f"round {i + 1:>2}  {time.perf_counter() - start:6.3f}s  {status}")
+        if hung:
+            break # the stuck threads hold the engine, later rounds would only pile up behind them
+    print("all rounds resolved every name" if not failed else f"{failed} round(s) failed")
@@ -1,158 +1,472 @@
 import socket
 import time
-import csv
-from dnslib import DNSRecord, DNSHeader, DNSQuestion, QTYPE, RR, A
-from collections import OrderedDict
+import asyncio
+import threading
+import struct
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dnslib import DNSRecord, DNSHeader, DNSQuestion, EDNS0, CLASS, QTYPE, RCODE, RR
+import workers
+from dns_cache import RRsetCache, RRSET_TYPES, describe
+from upstream import UpstreamPool
+from wire_cache import WireCache
+from query_parser import parse_query, from_record
+from query_log import AsyncLogWriter, CsvSink, LogRecord
+from resolver import Resolver, STEPS
+from root_zone import RootZone
+from log_segments import SegmentSink
+from metrics import Metrics, RateMeter, serve_metrics
+from tracing import Tracer, collapsed, sample_stacks, install_signal_handlers
 
 # config
 LISTEN_IP = "10.0.0.5"  # DNS server IP
 LISTEN_PORT = 53 # dns goes through this port, udp
 CACHE_LIMIT = 400 # 400 rn, not a
+CACHE_POLICY = "w-tinylfu" # eviction for the answer cache: "lru", "slru", "arc" or "w-tinylfu", compare them with bench_cache.py
 ROOT_SERVERS = ["198.41.0.4", "170.247.170.2", "192.33.4.12", "199.7.91.13",
                 "192.203.230.10", "192.5.5.241", "192.112.36.4", "198.97.190.53",
                 "192.36.148.17", "192.58.128.30", "193.0.14.129", "199.7.83.42",
                 "202.12.27.33"]
 LOG_FILE = "/home/mininet/dns-query-resolution/dns_log.csv"
+ROOT_ZONE_FILE = None # path to a copy of the root zone (rfc 8806) to skip the root hop, e.g. internic's root.zone
+ROOT_ZONE_RELOAD = 3600 # seconds between checks for a newer root zone file
+LOG_FORMAT = "csv" # "csv" writes LOG_FILE as before, "segments" writes rotated compressed segments into LOG_DIR (read them with log_segments.py)
+LOG_DIR = "/home/mininet/dns-query-resolution/dns_log"
+LOG_SEGMENT_BYTES = 16 << 20 # start a new segment past this size
+LOG_SEGMENT_SECONDS = 3600 # or after this long
+LOG_KEEP_SEGMENTS = 48 # older segments get deleted, 0 keeps all of them
+SERVER_MODE = "async" # "async" resolves many queries at once, "blocking" is the old one query at a time loop
+MAX_INFLIGHT = 256 # max resolutions running at the same time in async mode, the rest wait for a slot
+WORKERS = 1 # >1 pre-forks this many processes on LISTEN_IP:LISTEN_PORT with SO_REUSEPORT, one per core is a good start
+STATS_INTERVAL = 10 # seconds between per-worker qps reports when WORKERS > 1
+UPSTREAM_SOCKETS = 4 # long lived sockets used for all root/tld/authoritative queries
+EDNS_BUFSIZE = 1232 # edns udp payload size, advertised upstream and the most we send back to edns clients (dns flag day 2020 value)
+LISTEN_BUFSIZE = 4096 # biggest query we read off the listening socket
+TCP_ENABLED = True # rfc 7766 tcp listener on the same ip:port
+TCP_IDLE_TIMEOUT = 10 # seconds a tcp connection may sit without sending a query
+TCP_MAX_PIPELINE = 32 # queries in flight per tcp connection, reading pauses beyond this
+TCP_MAX_CONNECTIONS = 512
+TCP_MAX_MESSAGE = 65535 # tcp replies are only limited by the 2 byte length prefix
+HEDGE_MODE = "hedge" # "hedge" adds a parallel query when a server is slow, "fanout" asks FANOUT_K servers at once, "off" asks one at a time
+HEDGE_PERCENTILE = 0.9 # a server slower than this percentile of the step's recent rtts gets hedged
+HEDGE_DEFAULT_DELAY = 0.75 # used until a step has enough rtt samples for the percentile
+FANOUT_K = 2
+RRSET_ORDER = "cyclic" # order of multi-record answers: "cyclic" rotates them per query, "random" shuffles, "fixed" keeps upstream's
+PREFETCH_FRACTION = 0.1 # names read PREFETCH_MIN_HITS times get refreshed in the background in the last 10% of their ttl, 0 turns it off
+PREFETCH_MIN_HITS = 3
+PREFETCH_RATE = 10 # prefetch walks started per second at most
+STALE_WINDOW = 86400 # rfc 8767 serve-stale: expired answers are kept this long to answer with when upstream fails, 0 turns it off
+STALE_ANSWER_TIMEOUT = 1.8 # a miss with a stale copy gets the stale copy if the walk takes longer than this
+LOG_BUFFER = 65536 # log records waiting for the writer thread, beyond this LOG_POLICY kicks in
+LOG_BATCH = 512 # records written per batch, a full batch is written right away
+LOG_FLUSH_INTERVAL = 1.0 # seconds, a partial batch never waits longer than this
+LOG_POLICY = "drop" # "drop" loses records (and counts them) when the buffer is full, "block" makes the handler wait
+METRICS_ENABLED = True # prometheus style text on http://METRICS_IP:METRICS_PORT/metrics
+METRICS_IP = "127.0.0.1"
+METRICS_PORT = 9153 # worker n listens on METRICS_PORT + n when WORKERS > 1
+TRACE_ENABLED = True # keep per phase spans of recent queries, dumped by SIGUSR1 or GET /trace on the metrics port
+TRACE_BUFFER = 100000 # spans kept, oldest dropped first
+TRACE_DIR = "/home/mininet/dns-query-resolution/traces" # where SIGUSR1 traces and SIGUSR2 profiles are written
+PROFILE_SECONDS = 10 # how long SIGUSR2 samples stacks, GET /profile?seconds=n picks its own
 
-class LRUCache: # lru jic
-    def __init__(self, capacity):
-        self.cache = OrderedDict()
-        self.capacity = capacity
+engine = None # resolver.Resolver, built in main() so importing this file doesn't open sockets or files
+query_log = None
+wire_cache = WireCache(CACHE_LIMIT) # raw question bytes -> packed reply, the no-parse fast path for hits
+counters = {"client_truncated": 0} # replies cut down to fit, the engine counts upstream truncation itself
+counter_lock = threading.Lock()
 
-    def get(self, key):
-        if key in self.cache:
-            self.cache.move_to_end(key) # cool
-            return self.cache[key]
+def count(name):
+    with counter_lock:
+        counters[name] += 1
+
+tracer = Tracer(TRACE_BUFFER, TRACE_ENABLED)
+metrics = Metrics() # counters and histograms behind the metrics endpoint
+qps = RateMeter()
+query_time = metrics.histogram("dns_query_seconds", "time from receiving a query to having its reply ready")
+step_time = {step: metrics.histogram("dns_step_seconds", "wall time of each resolution step, first query sent to the reply used", step=step) for step in STEPS}
+resolvers = [] # AsyncResolvers in this process, for the in-flight gauge
+metrics.describe("dns_cache_lookups_total", "queries by how they were answered (hit, negative_hit, coalesced, miss, failed)")
+metrics.describe("dns_malformed_total", "packets that could not be parsed as a query")
+metrics.describe("dns_notimp_total", "queries for a type or class we don't resolve, answered NOTIMP")
+SUPPORTED_TYPES = {getattr(QTYPE, t) for t in RRSET_TYPES}
+
+def make_engine(cache=None):
+    # cache is the shared proxy when WORKERS > 1, else the engine makes its own
+    root_zone = RootZone(ROOT_ZONE_FILE, ROOT_ZONE_RELOAD).start() if ROOT_ZONE_FILE else None
+    return Resolver(ROOT_SERVERS, cache=cache, upstream=UpstreamPool(UPSTREAM_SOCKETS, EDNS_BUFSIZE), query_log=query_log,
+                    tracer=tracer, step_time=step_time, cache_limit=CACHE_LIMIT, hedge_mode=HEDGE_MODE,
+                    hedge_percentile=HEDGE_PERCENTILE, hedge_default_delay=HEDGE_DEFAULT_DELAY, fanout_k=FANOUT_K,
+                    root_zone=root_zone, rrset_order=RRSET_ORDER, prefetch_fraction=PREFETCH_FRACTION,
+                    prefetch_min_hits=PREFETCH_MIN_HITS, prefetch_rate=PREFETCH_RATE, stale_window=STALE_WINDOW,
+                    stale_answer_timeout=STALE_ANSWER_TIMEOUT, cache_policy=CACHE_POLICY)
+
+def open_query_log():
+    if LOG_FORMAT == "segments":
+        sink = SegmentSink(LOG_DIR, max_bytes=LOG_SEGMENT_BYTES, max_seconds=LOG_SEGMENT_SECONDS, keep=LOG_KEEP_SEGMENTS)
+    else:
+        sink = CsvSink(LOG_FILE) # csv columns from the question
+    return AsyncLogWriter(sink, LOG_BUFFER, LOG_BATCH, LOG_FLUSH_INTERVAL, LOG_POLICY)
+
+worker_id = 0 # set in each forked worker
+worker_stats = None # shared per-worker query counters, only used when WORKERS > 1
+
+def count_query(logs, start):
+    # start is time.perf_counter() from when the query came in
+    if worker_stats is not None:
+        worker_stats.count(worker_id)
+    qps.mark()
+    query_time.record(time.perf_counter() - start)
+    tracer.add("query", int(start * 1e9), logs[0].domain if logs else None) # same clock as perf_counter_ns
+    metrics.inc("dns_cache_lookups_total", result=logs[0].cache_status.lower() if logs else "failed")
+
+def cache_ratios():
+    by_result = {dict(labels)["result"]: n for labels, n in metrics.counter_values("dns_cache_lookups_total").items()}
+    total = sum(by_result.values())
+    return [({"result": r}, round(n / total, 4)) for r, n in sorted(by_result.items())] if total else []
+
+def upstream_timeouts():
+    return [({"server": ip}, s[4]) for ip, s in sorted(engine.infra.snapshot().items()) if s[4]]
+
+metrics.collect("dns_qps", "gauge", "queries answered per second over the last 10 s", qps.rate)
+metrics.collect("dns_cache_ratio", "gauge", "share of all queries per cache result", cache_ratios)
+metrics.collect("dns_inflight_walks", "gauge", "distinct names being resolved upstream right now", lambda: engine.inflight.inflight())
+metrics.collect("dns_inflight_queries", "gauge", "client queries waiting on an upstream walk", lambda: sum(r.inflight for r in resolvers))
+metrics.collect("dns_upstream_timeouts_total", "counter", "upstream queries that timed out, per server", upstream_timeouts)
+TRUNCATION_EVENTS = ("upstream_truncated", "upstream_tcp_failed", "client_truncated")
+PREFETCH_RESULTS = ("started", "rate_limited", "failed")
+metrics.collect("dns_truncation_events_total", "counter", "truncated replies, upstream and to clients", lambda: [({"event": k}, {**engine.counters, **counters}[k]) for k in TRUNCATION_EVENTS])
+metrics.collect("dns_prefetch_total", "counter", "background refreshes of hot names about to expire", lambda: [({"result": r}, engine.counters["prefetch_" + r]) for r in PREFETCH_RESULTS])
+metrics.collect("dns_stale_answers_total", "counter", "expired answers served because upstream failed or was slow (rfc 8767)", lambda: engine.counters["stale_served"])
+metrics.collect("dns_log_dropped_total", "counter", "query log records dropped because the buffer was full", lambda: query_log.dropped)
+
+def trace_route(params):
+    return "application/json", json.dumps(tracer.chrome_trace()).encode()
+
+def profile_route(params): # blocks this http thread for the sampling time, the dns side keeps running
+    seconds = min(float(params.get("seconds", PROFILE_SECONDS)), 60)
+    return "text/plain", collapsed(sample_stacks(seconds)).encode()
+
+def start_metrics():
+    if not METRICS_ENABLED:
+        return
+    try:
+        serve_metrics(metrics, METRICS_IP, METRICS_PORT + worker_id, {"/trace": trace_route, "/profile": profile_route})
+        print(f"metrics on http://{METRICS_IP}:{METRICS_PORT + worker_id}/metrics")
+    except OSError as e:
+        print(f"metrics endpoint not started: {e}")
+
+def write_logs(logs): # only queues them, the writer thread does the disk io, used for wire cache hits (the engine logs the rest)
+    span_start = time.perf_counter_ns()
+    query_log.write(logs)
+    tracer.add("log", span_start)
+
+def decode(data):
+    # ParsedQuery from the quick memoryview parser, or from a full dnslib parse for unusual packets
+    # raises MalformedQuery / DNSError for garbage
+    span_start = time.perf_counter_ns()
+    pq = parse_query(data)
+    if pq is None:
+        pq = from_record(DNSRecord.parse(data))
+    tracer.add("parse", span_start, pq.qname)
+    return pq
+
+def formerr(data):
+    # header-only FORMERR reply for a packet we couldn't make sense of, None if there isn't even a header
+    if len(data) < 12:
+        return None
+    txid, flags = struct.unpack_from("!HH", data, 0)
+    return struct.pack("!HHHHHH", txid, 0x8000 | (flags & 0x7900) | 0x0080 | RCODE.FORMERR, 0, 0, 0, 0) # qr, opcode+rd echoed, ra
+
+def max_udp(pq):
+    # rfc 6891: edns clients tell us what they can take (capped at our own buffer), everyone else gets 512
+    return min(pq.edns_size, EDNS_BUFSIZE) if pq.edns_size else 512
+
+def build_reply(pq, answer, ttl, negative=None, limit=512):
+    reply = DNSRecord(DNSHeader(id=pq.txid, qr=1, aa=1, ra=1), q=DNSQuestion(pq.qname, pq.qtype, pq.qclass)) # rd-recursion desired, ra-recursion available, qr-0 query 1 response, aa-authoritative answer
+    if negative:
+        rcode, soa = negative
+        if rcode == "NXDOMAIN":
+            reply.header.rcode = RCODE.NXDOMAIN
+        if soa is not None: # rfc 2308, the soa goes in the authority section so downstream caches know how long to keep it
+            reply.add_auth(RR(rname=soa.rname, rtype=QTYPE.SOA, rclass=1, ttl=ttl, rdata=soa.rdata))
+    for rr in answer: # cname chain then the rrset, each carrying whatever is left of its upstream ttl
+        reply.add_answer(rr)
+    if pq.edns_size:
+        reply.add_ar(EDNS0(udp_len=EDNS_BUFSIZE))
+    packet = reply.pack()
+    if len(packet) > limit: # doesn't fit, send just the header + question with tc set so the client retries over tcp
+        count("client_truncated")
+        reply.rr, reply.auth = [], []
+        reply.ar = [rr for rr in reply.ar if rr.rtype == QTYPE.OPT]
+        reply.header.tc = 1
+        packet = reply.pack()
+    return packet
+
+def notimp(pq):
+    # header + question with NOTIMP, for query types and classes the engine doesn't resolve
+    metrics.inc("dns_notimp_total", qtype=QTYPE.get(pq.qtype, str(pq.qtype)))
+    reply = DNSRecord(DNSHeader(id=pq.txid, qr=1, rd=pq.rd, ra=1, rcode=RCODE.NOTIMP), q=DNSQuestion(pq.qname, pq.qtype, pq.qclass))
+    return reply.pack()
+
+def fast_path(data, pq, limit):
+    # (packed reply, logs) straight from the wire cache, None if the slow path has to handle it
+    span_start = time.perf_counter_ns()
+    hit = wire_cache.get(data, pq, limit)
+    tracer.add("wire_cache", span_start, pq.qname)
+    if hit is None:
         return None
+    packet, entry = hit
+    if PREFETCH_FRACTION and entry.prefetch_due(time.monotonic(), PREFETCH_FRACTION, PREFETCH_MIN_HITS):
+        engine.prefetch(entry.qname, QTYPE[pq.qtype])
+    return packet, [LogRecord(time.strftime("%Y-%m-%d %H:%M:%S"), entry.qname, "Cache", "-", "Cache", entry.response, 0, 0, entry.status)]
 
-    def put(self, key, value):
-        self.cache[key] = value
-        self.cache.move_to_end(key)
-        if len(self.cache) > self.capacity:
-            self.cache.popitem(last=False)
-
-cache = LRUCache(CACHE_LIMIT) # init cache
-
-csv_file = open(LOG_FILE, 'w', newline='')
-csv_writer = csv.DictWriter(csv_file, fieldnames=[ # from the question
-    "timestamp","domain","resolution_mode","server_ip",
-    "step","response","rtt","total_time","cache_status"
-])
-csv_writer.writeheader()
-
-def query_server(domain, server_ip):
-    q = DNSRecord.question(domain) # creating the query with the domain name, asks for A type record
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # opening udp socket, af_inet - ipv4 addr family, sock_dgram - datagram mode
-    s.settimeout(3) # will wait 3 seconds for reply
-    start = time.time()
+def reply_packet(data, pq, result, limit):
+    # packs the reply for a resolved query and keeps a copy in the wire cache for next time
+    answer, ttl, negative, logs = result
+    span_start = time.perf_counter_ns()
+    packet = build_reply(pq, answer, ttl, negative, limit)
+    if ttl > 0 and (answer or negative) and logs[0].cache_status != "STALE": # stale answers are retried, not kept
+        if answer:
+            if RRSET_ORDER == "fixed" or sum(rr.rtype == pq.qtype for rr in answer) < 2: # rotated answers have to go through the engine
+                wire_cache.put(data, pq, packet, pq.qname.lower(), describe(answer))
+        else:
+            wire_cache.put(data, pq, packet, pq.qname.lower(), negative[0], "NEGATIVE_HIT")
+    tracer.add("serialize", span_start, pq.qname)
+    return packet
+
+def serve_blocking(sock):
     try:
-        s.sendto(q.pack(), (server_ip, 53)) # sending the created query packet converted to bytes to the server ip port 53
-        data, _ = s.recvfrom(512) # conventionally max size is 512 bytes
-        rtt = time.time() - start
-        response = DNSRecord.parse(data) # parse converts from binary to human-readable
-        return response, rtt
-    except socket.timeout:
-        return None, None
+        while True: # continuously listening
+            data, addr = sock.recvfrom(LISTEN_BUFSIZE) # whatever you received, edns queries can be bigger than 512
+            start = time.perf_counter()
+            try:
+                pq = decode(data)
+            except Exception as e:
+                print(f"malformed packet from {addr}: {e}")
+                metrics.inc("dns_malformed_total")
+                packet = formerr(data)
+                if packet:
+                    sock.sendto(packet, addr)
+                continue
+            if pq.qtype not in SUPPORTED_TYPES or pq.qclass != CLASS.IN:
+                sock.sendto(notimp(pq), addr)
+                continue
+            limit = max_udp(pq)
+            fast = fast_path(data, pq, limit)
+            if fast is not None:
+                packet, logs = fast
+                write_logs(logs)
+            else:
+                result = engine.resolve(pq.qname, QTYPE[pq.qtype])
+                packet, logs = reply_packet(data, pq, result, limit), result[3]
+            sock.sendto(packet, addr)
+            count_query(logs, start)
     finally:
-        s.close() # closes socket in any case
-
-def recursive_resolve(domain):
-    log_entries = [] # list of dicts
-    total_start = time.time()
-    cached = cache.get(domain) # cache key if found else None
-    if cached: # if found in cache
-        total_time = time.time() - total_start
-        log_entries.append({
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "domain": domain,
-            "resolution_mode": "Cache",
-            "server_ip": "-",
-            "step": "Cache",
-            "response": cached,
-            "rtt": 0,
-            "total_time": total_time,
-            "cache_status": "HIT"
-        })
-        return cached, log_entries
-    current_servers = ROOT_SERVERS.copy() # didn't find domain name in cache, start looking from root servers
-    response_ip = None
-    for step_name in ["Root", "TLD", "Authoritative"]:
-        for server in current_servers: # going through all servers in this step
-            resp, rtt = query_server(domain, server)
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            if resp is None:
-                continue  # try next server
-            answer = resp.rr # found response, will get either next step servers or resolved ip
-            if answer: # if found ip
-                response_ip = str(answer[0].rdata)
-                log_entries.append({
-                    "timestamp": timestamp,
-                    "domain": domain,
-                    "resolution_mode": "Recursive",
-                    "server_ip": server,
-                    "step": step_name,
-                    "response": response_ip,
-                    "rtt": round(rtt, 4),
-                    "total_time": 0,  # will update later
-                    "cache_status": "MISS"
-                })
-                total_time = time.time() - total_start
-                for entry in log_entries:
-                    entry["total_time"] = round(total_time, 4)
-                cache.put(domain, response_ip)
-                return response_ip, log_entries
-            additional = resp.ar # additional records - next step servers
-            new_servers = [str(rr.rdata) for rr in additional if rr.rtype == QTYPE.A] # getting ip from the recs
-            if new_servers:
-                current_servers = new_servers
-                log_entries.append({
-                    "timestamp": timestamp,
-                    "domain": domain,
-                    "resolution_mode": "Recursive",
-                    "server_ip": server,
-                    "step": step_name,
-                    "response": ",".join(new_servers), # comma separated list of 
-                    "rtt": round(rtt, 4),
-                    "total_time": 0,
-                    "cache_status": "MISS"
-                })
-                break
-        else:
-            continue # else to the for server loop, done with servers in this step, move to the next
-    total_time = time.time() - total_start
-    for entry in log_entries:
-        entry["total_time"] = round(total_time, 4)
-    return response_ip, log_entries
-
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # udp socket, same thing as before
-sock.bind((LISTEN_IP, LISTEN_PORT)) # listening at ip 10.0.0.5, port 53, could also put ip as 0.0.0.0 implying listen at all interfaces
-print(f"dns server listening on {LISTEN_IP}:{LISTEN_PORT}")
-try:
-    while True: # continuously listening
-        data, addr = sock.recvfrom(512) # whatever you received 
-        request = DNSRecord.parse(data)
-        qname = str(request.q.qname).rstrip('.') # extra . at the end of domain name
-        ip, logs = recursive_resolve(qname)
-        for entry in logs:
-            csv_writer.writerow(entry)
-        csv_file.flush()
-        reply = DNSRecord(DNSHeader(id=request.header.id, qr=1, aa=1, ra=1), q=request.q) # rd-recursion desired, ra-recursion available, qr-0 query 1 response, aa-authoritative answer
-        if ip:
+        sock.close() # closing socket
+
+class AsyncResolver:
+    # the part shared by the udp and tcp listeners
+    # anything we can answer right away (junk, wire cache and cache hits) is done on the event loop,
+    # misses go to the executor so one slow walk doesn't block anyone else
+    def __init__(self, loop, executor, max_inflight):
+        self.loop = loop
+        self.executor = executor
+        self.slots = asyncio.Semaphore(max_inflight) # extra misses wait here instead of piling onto the executor
+        self.inflight = 0
+
+    def answer_now(self, data, tcp, peer):
+        # (packet, None) if answered straight away (packet None means drop it), (None, miss) if it needs a walk
+        start = time.perf_counter()
+        try:
+            pq = decode(data)
+        except Exception as e:
+            print(f"malformed packet from {peer}: {e}")
+            metrics.inc("dns_malformed_total")
+            return formerr(data), None
+        if pq.qtype not in SUPPORTED_TYPES or pq.qclass != CLASS.IN:
+            return notimp(pq), None
+        limit = TCP_MAX_MESSAGE if tcp else max_udp(pq)
+        fast = fast_path(data, pq, limit)
+        if fast is not None: # answered from the wire cache, no dnslib involved
+            packet, logs = fast
+            write_logs(logs)
+            count_query(logs, start)
+            return packet, None
+        qname = pq.qname.lower()
+        hit = engine.lookup(qname, QTYPE[pq.qtype])
+        if hit is not None:
+            return self.finish(data, pq, hit, limit, start), None
+        return None, (pq, qname, limit, start)
+
+    async def resolve(self, data, miss):
+        pq, qname, limit, start = miss
+        async with self.slots:
+            self.inflight += 1
             try:
-                reply.add_answer(RR(
-                    rname=request.q.qname,
-                    rtype=QTYPE.A,
-                    rclass=1, # class 1 is internet, otherwise can be some archaic networks or none or any
-                    ttl=60, # 60 seconds
-                    rdata=A(ip) # ipv4 addr
-                ))
+                result = await self.loop.run_in_executor(self.executor, engine.resolve, qname, QTYPE[pq.qtype])
             except Exception as e:
-                print(f"error creating rr for {ip}: {e}")
-        sock.sendto(reply.pack(), addr)
+                print(f"error resolving {qname}: {e}")
+                result = [], 0, None, []
+            finally:
+                self.inflight -= 1
+        return self.finish(data, pq, result, limit, start)
+
+    def finish(self, data, pq, result, limit, start):
+        packet = reply_packet(data, pq, result, limit)
+        count_query(result[3], start)
+        return packet
+
+class AsyncDNSProtocol(asyncio.DatagramProtocol):
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.tasks = set() # keep refs so pending tasks don't get garbage collected
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        packet, miss = self.resolver.answer_now(data, False, addr)
+        if miss is None:
+            if packet:
+                self.transport.sendto(packet, addr)
+            return
+        task = self.resolver.loop.create_task(self.resolve_and_send(data, miss, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def resolve_and_send(self, data, miss, addr):
+        self.transport.sendto(await self.resolver.resolve(data, miss), addr)
+
+class TCPConnections:
+    # rfc 7766 tcp front end: persistent connections, several queries in flight per connection,
+    # answers written back in whatever order they finish (clients match them up by txid)
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.open = 0
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        if self.open >= TCP_MAX_CONNECTIONS:
+            writer.close()
+            return
+        self.open += 1
+        write_lock = asyncio.Lock()
+        pending = set()
+        try:
+            while True:
+                try: # 2 byte length prefix then the message, drop the connection once it sits idle
+                    header = await asyncio.wait_for(reader.readexactly(2), TCP_IDLE_TIMEOUT)
+                    data = await asyncio.wait_for(reader.readexactly(struct.unpack("!H", header)[0]), TCP_IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                packet, miss = self.resolver.answer_now(data, True, peer)
+                if miss is None:
+                    if not packet:
+                        break # not even a header, nothing sensible to say on this connection
+                    await self.send(writer, write_lock, packet)
+                    continue
+                if len(pending) >= TCP_MAX_PIPELINE: # enough in flight on this connection, stop reading until one finishes
+                    await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                task = self.resolver.loop.create_task(self.resolve_and_send(data, miss, writer, write_lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            if pending: # answer whatever is still in flight before closing
+                await asyncio.gather(*pending, return_exceptions=True)
+            self.open -= 1
+            writer.close()
+
+    async def resolve_and_send(self, data, miss, writer, write_lock):
+        await self.send(writer, write_lock, await self.resolver.resolve(data, miss))
+
+    async def send(self, writer, write_lock, packet):
+        async with write_lock: # one message at a time so length prefixes and bodies never interleave
+            writer.write(struct.pack("!H", len(packet)) + packet)
+            await writer.drain()
+
+def start_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = ThreadPoolExecutor(max_workers=MAX_INFLIGHT)
+    resolver = AsyncResolver(loop, executor, MAX_INFLIGHT)
+    resolvers.append(resolver)
+    return loop, executor, resolver
+
+def serve_async(sock, tcp_sock):
+    loop, executor, resolver = start_loop()
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: AsyncDNSProtocol(resolver),
+        sock=sock
+    ))
+    tcp_server = None
+    if tcp_sock is not None: # same cache and resolution engine, just a different transport
+        tcp_server = loop.run_until_complete(asyncio.start_server(TCPConnections(resolver).handle, sock=tcp_sock))
+    try:
+        loop.run_forever()
+    finally:
+        transport.close()
+        if tcp_server is not None:
+            tcp_server.close()
+        executor.shutdown(wait=False)
+        loop.close()
+
+def serve_tcp_only(tcp_sock):
+    # tcp listener on its own thread + loop, for blocking mode
+    loop, executor, resolver = start_loop()
+    loop.run_until_complete(asyncio.start_server(TCPConnections(resolver).handle, sock=tcp_sock))
+    loop.run_forever()
+
+def serve(sock, tcp_sock):
+    start_metrics()
+    if SERVER_MODE == "async":
+        serve_async(sock, tcp_sock)
+    else:
+        if tcp_sock is not None:
+            threading.Thread(target=serve_tcp_only, args=(tcp_sock,), daemon=True).start()
+        serve_blocking(sock)
 
-except KeyboardInterrupt:
-    print("keyboard interrupt, shutting down dns server")
+def listen_tcp():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((LISTEN_IP, LISTEN_PORT))
+    return s
+
+def run_worker(wid, stats): # entry point of each forked worker
+    global worker_id, worker_stats
+    worker_id, worker_stats = wid, stats
+    tcp_sock = workers.reuseport_socket(LISTEN_IP, LISTEN_PORT, socket.SOCK_STREAM) if TCP_ENABLED else None
+    try:
+        serve(workers.reuseport_socket(LISTEN_IP, LISTEN_PORT), tcp_sock)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        query_log.close() # write out whatever this worker still has buffered
+
+def main():
+    global engine, query_log
+    install_signal_handlers(tracer, TRACE_DIR, PROFILE_SECONDS) # forked workers inherit these, signal a worker's pid to dump that worker
+    query_log = open_query_log()
+    print(f"dns server listening on {LISTEN_IP}:{LISTEN_PORT} ({'udp+tcp' if TCP_ENABLED else 'udp'}, {SERVER_MODE} mode, {WORKERS} worker(s))")
+    try:
+        if WORKERS > 1:
+            cache_manager, cache = workers.start_shared_cache(lambda: RRsetCache(CACHE_LIMIT, stale_ttl=STALE_WINDOW, policy=CACHE_POLICY)) # hits in one worker count for all of them
+            engine = make_engine(cache)
+            workers.run_workers(WORKERS, run_worker, STATS_INTERVAL)
+        else:
+            engine = make_engine()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # udp socket, same thing as before
+            sock.bind((LISTEN_IP, LISTEN_PORT)) # listening at ip 10.0.0.5, port 53, could also put ip as 0.0.0.0 implying listen at all interfaces
+            serve(sock, listen_tcp() if TCP_ENABLED else None)
+
+    except KeyboardInterrupt:
+        print("keyboard interrupt, shutting down dns server")
+        print(f"engine counters: {dict(engine.counters, **counters) if engine else counters}")
+
+    finally:
+        query_log.close() # drains the buffer and closes the csv file
+        if query_log.dropped:
+            print(f"query log dropped {query_log.dropped} records (buffer full)")
 
-finally:
-    csv_file.close() # closing csv file
-    sock.close() # closing socket
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,16 @@
 import socket
 import time
-import csv
-from dnslib import DNSRecord, DNSHeader, QTYPE, RR, A
-from collections import OrderedDict
+from dnslib import DNSRecord, DNSHeader, CLASS, QTYPE, RCODE
+import workers
+from dns_cache import RRsetCache, RRSET_TYPES, describe
+from query_log import AsyncLogWriter, CsvSink, LogRecord
+from resolver import Resolver, STALE_WINDOW
 
 #Configuration
 LISTEN_IP = "10.0.0.5"
 LISTEN_PORT = 53
 CACHE_LIMIT = 400
+CACHE_POLICY = "lru"  # or "slru", "arc", "w-tinylfu" (see bench_cache.py)
 ROOT_SERVERS = [
     "198.41.0.4", "170.247.170.2", "192.33.4.12", "199.7.91.13",
     "192.203.230.10", "192.5.5.241", "192.112.36.4", "198.97.190.53",
@@ -15,160 +18,40 @@ ROOT_SERVERS = [
     "202.12.27.33"
 ]
 LOG_FILE = "/home/mininet/dns-query-resolution/dns_log_e.csv"
+WORKERS = 1  # >1 pre-forks worker processes sharing the port via SO_REUSEPORT
+STATS_INTERVAL = 10  # seconds between per-worker qps reports
 
-#LRU Cache
-class LRUCache:
-    def __init__(self, capacity):
-        self.cache = OrderedDict()
-        self.capacity = capacity
-
-    def get(self, key):
-        if key in self.cache:
-            self.cache.move_to_end(key)
-            return self.cache[key]
-        return None
-
-    def put(self, key, value):
-        self.cache[key] = value
-        self.cache.move_to_end(key)
-        if len(self.cache) > self.capacity:
-            self.cache.popitem(last=False)
-
-cache = LRUCache(CACHE_LIMIT)
-
-#CSV Setup
-csv_file = open(LOG_FILE, 'w', newline='')
-csv_writer = csv.DictWriter(csv_file, fieldnames=[
-    "timestamp", "domain", "resolution_mode", "server_ip",
-    "step", "response", "rtt", "total_time", "cache_status"
-])
-csv_writer.writeheader()
-
-#Query Helper
-def query_server(domain, server_ip):
-    q = DNSRecord.question(domain)
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.settimeout(3)
-    start = time.time()
-    try:
-        s.sendto(q.pack(), (server_ip, 53))
-        data, _ = s.recvfrom(512)
-        rtt = time.time() - start
-        response = DNSRecord.parse(data)
-        return response, rtt
-    except socket.timeout:
-        return None, None
-    finally:
-        s.close()
-
-#Recursive Resolver
-def recursive_resolve(domain):
-    log_entries = []
-    total_start = time.time()
-    cached = cache.get(domain)
-    if cached:
-        total_time = time.time() - total_start
-        log_entries.append({
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "domain": domain,
-            "resolution_mode": "Recursive",
-            "server_ip": "-",
-            "step": "Cache",
-            "response": cached,
-            "rtt": 0,
-            "total_time": round(total_time, 4),
-            "cache_status": "HIT"
-        })
-        return cached, log_entries
-
-    current_servers = ROOT_SERVERS.copy()
-    response_ip = None
-
-    for step_name in ["Root", "TLD", "Authoritative"]:
-        for server in current_servers:
-            resp, rtt = query_server(domain, server)
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-
-            if resp is None:
-                continue
-
-            # Found final answer
-            if resp.rr:
-                response_ip = str(resp.rr[0].rdata)
-                log_entries.append({
-                    "timestamp": timestamp,
-                    "domain": domain,
-                    "resolution_mode": "Recursive",
-                    "server_ip": server,
-                    "step": step_name,
-                    "response": response_ip,
-                    "rtt": round(rtt, 4),
-                    "total_time": 0,
-                    "cache_status": "MISS"
-                })
-                total_time = time.time() - total_start
-                for entry in log_entries:
-                    entry["total_time"] = round(total_time, 4)
-                cache.put(domain, response_ip)
-                return response_ip, log_entries
-
-            additional = resp.ar
-            new_servers = [str(rr.rdata) for rr in additional if rr.rtype == QTYPE.A]
-            if new_servers:
-                current_servers = new_servers
-                log_entries.append({
-                    "timestamp": timestamp,
-                    "domain": domain,
-                    "resolution_mode": "Recursive",
-                    "server_ip": server,
-                    "step": step_name,
-                    "response": ",".join(new_servers),
-                    "rtt": round(rtt, 4),
-                    "total_time": 0,
-                    "cache_status": "MISS"
-                })
-                break
-
-    total_time = time.time() - total_start
-    for entry in log_entries:
-        entry["total_time"] = round(total_time, 4)
-    return response_ip, log_entries
+#Engine and log, set up in main()
+engine = None
+query_log = None
 
 #Main Server
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((LISTEN_IP, LISTEN_PORT))
-print(f"[+] Custom DNS Server listening on {LISTEN_IP}:{LISTEN_PORT}")
+worker_id = 0
+worker_stats = None # per-worker query counters when WORKERS > 1
 
-try:
+def serve(sock):
     while True:
         data, addr = sock.recvfrom(512)
         request = DNSRecord.parse(data)
         qname = str(request.q.qname).rstrip('.')
+        qtype = QTYPE.get(request.q.qtype)
 
         recursion_requested = bool(request.header.rd)
-        print(f"[+] Received query for {qname}, RD={recursion_requested}")
+        print(f"[+] Received query for {qname} {qtype}, RD={recursion_requested}")
+
+        if qtype not in RRSET_TYPES or request.q.qclass != CLASS.IN:
+            reply = request.reply()
+            reply.header.rcode = RCODE.NOTIMP
+            sock.sendto(reply.pack(), addr)
+            continue
 
+        negative = None
         if recursion_requested:
-            ip, logs = recursive_resolve(qname)
-            mode = "Recursive"
+            answer, ttl, negative, logs = engine.resolve(qname, qtype) # the engine writes its own log records
         else:
-            ip = cache.get(qname)
-            logs = [{
-                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                "domain": qname,
-                "resolution_mode": "Non-Recursive",
-                "server_ip": "-",
-                "step": "Cache",
-                "response": ip if ip else "N/A",
-                "rtt": 0,
-                "total_time": 0,
-                "cache_status": "HIT" if ip else "MISS"
-            }]
-            mode = "Non-Recursive"
-
-        for entry in logs:
-            csv_writer.writerow(entry)
-        csv_file.flush()
+            answer, ttl = engine.cached_answer(qname.lower(), qtype) or ([], 0)
+            query_log.write([LogRecord(time.strftime("%Y-%m-%d %H:%M:%S"), qname, "Non-Recursive", "-", "Cache",
+                                       describe(answer) or "N/A", 0, 0, "HIT" if answer else "MISS")])
 
         reply = DNSRecord(
             DNSHeader(
@@ -180,20 +63,49 @@ try:
             ),
             q=request.q
         )
+        if negative and negative[0] == "NXDOMAIN":
+            reply.header.rcode = RCODE.NXDOMAIN
 
-        if ip:
-            reply.add_answer(RR(
-                rname=request.q.qname,
-                rtype=QTYPE.A,
-                rclass=1,
-                ttl=60,
-                rdata=A(ip)
-            ))
+        for rr in answer:
+            reply.add_answer(rr)
 
         sock.sendto(reply.pack(), addr)
+        if worker_stats is not None:
+            worker_stats.count(worker_id)
+
+def run_worker(wid, stats):
+    global worker_id, worker_stats
+    worker_id, worker_stats = wid, stats
+    sock = workers.reuseport_socket(LISTEN_IP, LISTEN_PORT)
+    try:
+        serve(sock)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        query_log.close()
+
+def main():
+    global engine, query_log
+    query_log = AsyncLogWriter(CsvSink(LOG_FILE))
+    print(f"[+] Custom DNS Server listening on {LISTEN_IP}:{LISTEN_PORT} with {WORKERS} worker(s)")
+    try:
+        if WORKERS > 1:
+            cache_manager, cache = workers.start_shared_cache(lambda: RRsetCache(CACHE_LIMIT, stale_ttl=STALE_WINDOW, policy=CACHE_POLICY))
+            engine = Resolver(ROOT_SERVERS, cache=cache, query_log=query_log, cache_limit=CACHE_LIMIT)
+            workers.run_workers(WORKERS, run_worker, STATS_INTERVAL)
+        else:
+            engine = Resolver(ROOT_SERVERS, query_log=query_log, cache_limit=CACHE_LIMIT, cache_policy=CACHE_POLICY)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((LISTEN_IP, LISTEN_PORT))
+            try:
+                serve(sock)
+            finally:
+                sock.close()
+    except KeyboardInterrupt:
+        print("\n[!] DNS server shutting down...")
+    finally:
+        query_log.close()
 
-except KeyboardInterrupt:
-    print("\n[!] DNS server shutting down...")
-finally:
-    csv_file.close()
-    sock.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import threading
+import time
+from dnslib import QTYPE
+# zone cut cache: remembers NS referrals and their glue so a miss can start at the deepest known zone instead of the root
+# zones are stored in a trie of reversed labels, www.example.com walks "com" -> "example" -> "www"
+
+MAX_ZONES = 10000 # cuts kept before expired ones (then the ones closest to expiring) get pruned
+
+class ZoneNode:
+    __slots__ = ("children", "zone", "ns_names", "servers", "expires")
+
+    def __init__(self, zone):
+        self.children = {}
+        self.zone = zone
+        self.ns_names = []
+        self.servers = [] # glue ips, empty means we don't know this cut (or it expired)
+        self.expires = 0
+
+def in_bailiwick(name, zone):
+    return zone == "." or name == zone or name.endswith("." + zone)
+
+def labels(name):
+    name = name.rstrip('.').lower()
+    return name.split('.')[::-1] if name else []
+
+class DelegationCache:
+    def __init__(self, max_zones=MAX_ZONES):
+        self.root = ZoneNode(".")
+        self.max_zones = max_zones
+        self.zones = 0 # nodes that hold servers
+        self.lock = threading.Lock()
+
+    def put(self, zone, ns_names, servers, ttl):
+        if not servers or ttl <= 0:
+            return
+        with self.lock:
+            node = self.root
+            parts = labels(zone)
+            for i, label in enumerate(parts):
+                child = node.children.get(label)
+                if child is None:
+                    child = node.children[label] = ZoneNode(".".join(reversed(parts[:i + 1])))
+                node = child
+            if not node.servers:
+                self.zones += 1
+            node.ns_names = list(ns_names)
+            node.servers = list(servers)
+            node.expires = time.time() + ttl
+            if self.zones > self.max_zones:
+                self.prune()
+
+    def prune(self):
+        # drops expired cuts, then the ones closest to expiring until we're 10% under the cap, then the branches left empty
+        # caller holds the lock
+        now = time.time()
+        live = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if node.servers:
+                if node.expires > now:
+                    live.append((node.expires, id(node), node))
+                else:
+                    node.servers, node.ns_names = [], []
+        live.sort()
+        for _, _, node in live[:max(len(live) - int(self.max_zones * 0.9), 0)]:
+            node.servers, node.ns_names = [], []
+        self.zones = sum(1 for _, _, node in live if node.servers)
+        self.sweep(self.root)
+
+    def sweep(self, node):
+        # removes children that hold no servers and have none below them, true if node itself is now empty
+        for label, child in list(node.children.items()):
+            if self.sweep(child):
+                del node.children[label]
+        return not node.servers and not node.children
+
+    def find(self, qname):
+        # longest suffix match, returns (zone, servers) of the deepest unexpired cut or None
+        now = time.time()
+        best = None
+        with self.lock:
+            node = self.root
+            for label in labels(qname):
+                node = node.children.get(label)
+                if node is None:
+                    break
+                if node.servers:
+                    if node.expires > now:
+                        best = (node.zone, list(node.servers))
+                    else:
+                        self.zones -= 1
+                        node.servers, node.ns_names = [], [] # expired, drop it and keep looking for a shallower cut
+        return best
+
+def parse_referral(resp, server_zone="."):
+    # pulls (zone, ns names, glue ips, ttl) out of a referral, None if it isn't one
+    # only glue inside the zone of the server that answered is kept (a com server may vouch for ns1.provider.com,
+    # not for ns1.provider.net), anything else could be a poisoning attempt
+    ns_rrs = [rr for rr in resp.auth if rr.rtype == QTYPE.NS]
+    if not ns_rrs:
+        return None
+    zone = str(ns_rrs[0].rname).rstrip('.').lower() or "."
+    ns_rrs = [rr for rr in ns_rrs if (str(rr.rname).rstrip('.').lower() or ".") == zone]
+    ns_names = [str(rr.rdata).rstrip('.').lower() for rr in ns_rrs]
+    glue = [rr for rr in resp.ar if rr.rtype == QTYPE.A and str(rr.rname).rstrip('.').lower() in ns_names
+            and in_bailiwick(str(rr.rname).rstrip('.').lower(), server_zone)]
+    if not glue: # glueless, the caller has to look the ns names up itself
+        return zone, ns_names, [], min(rr.ttl for rr in ns_rrs)
+    ttl = min([rr.ttl for rr in ns_rrs] + [rr.ttl for rr in glue])
+    return zone, ns_names, [str(rr.rdata) for rr in glue], ttl
@@ -0,0 +1,193 @@
+import heapq
+import random
+import threading
+import time
+from dnslib import CLASS, QTYPE, RCODE, RR
+from eviction import make_policy
+# answer caches shared by the resolvers
+
+MAX_TTL = 86400 # never keep anything longer than a day, whatever upstream says
+MAX_NEGATIVE_TTL = 3600 # rfc 2308 suggests capping negative ttls at a few hours, an hour is plenty here
+RRSET_TYPES = ("A", "AAAA", "CNAME", "NS", "MX", "TXT", "SOA") # query types the servers resolve and cache, the rest get NOTIMP
+STALE_ANSWER_TTL = 30 # ttl on answers served past their expiry, rfc 8767 recommends 30 s
+MIN_PREFETCH_WINDOW = 2 # seconds, the last second of a ttl already counts as a miss so short ttls need a wider window
+
+class LRUCache: # lru jic, or any other eviction policy from eviction.py ("lru", "slru", "arc", "w-tinylfu")
+    def __init__(self, capacity, policy="lru"):
+        self.cache = {}
+        self.capacity = capacity
+        self.policy = make_policy(policy, capacity) # only tracks keys, decides what goes when we're full
+        self.lock = threading.Lock() # resolutions run on several threads, and the shared cache serves every worker
+
+    def get(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.policy.hit(key) # cool
+                return self.cache[key]
+            self.policy.miss(key)
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.store(key, value)
+
+    def store(self, key, value): # caller holds the lock
+        if key in self.cache:
+            self.cache[key] = value
+            self.policy.hit(key)
+            return
+        self.cache[key] = value
+        for victim in self.policy.add(key): # may be key itself if the policy didn't admit it
+            del self.cache[victim]
+
+    def drop(self, key): # caller holds the lock
+        del self.cache[key]
+        self.policy.remove(key)
+
+class TTLCache(LRUCache):
+    # size bounded cache (lru unless another policy is picked) where every entry also expires after the ttl upstream gave it
+    # expiry times sit in a min-heap so expired entries get dropped in order without scanning the whole cache
+    # entries are [value, expires, ttl, hits], hits drive prefetching
+    def __init__(self, capacity, max_ttl=MAX_TTL, stale_ttl=0, policy="lru"):
+        super().__init__(capacity, policy)
+        self.max_ttl = max_ttl
+        self.stale_ttl = stale_ttl # expired entries stay this much longer for get_stale (rfc 8767 serve-stale), 0 drops them on expiry
+        self.heap = [] # (expires + stale_ttl, key), stale heap entries are skipped when popped
+
+    def expire(self, now):
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            gone, key = heapq.heappop(heap)
+            entry = self.cache.get(key)
+            if entry is not None and entry[1] + self.stale_ttl == gone: # otherwise the key was re-put with a new expiry
+                self.drop(key)
+        if len(heap) > 2 * len(self.cache) + 64: # too many dead heap entries from evictions and refreshes
+            self.heap = [(entry[1] + self.stale_ttl, key) for key, entry in self.cache.items()]
+            heapq.heapify(self.heap)
+
+    def get_entry(self, key, prefetch=None):
+        # (value, remaining ttl in whole seconds) or None if missing or expired
+        # with prefetch=(fraction, min hits) it's (value, remaining, due), due is True for the one caller that should
+        # refresh the entry: it's in the last `fraction` of its ttl (MIN_PREFETCH_WINDOW s at least) and was read at least min hits times
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+            entry = self.cache.get(key)
+            remaining = int(entry[1] - now) if entry is not None else 0
+            if remaining <= 0: # missing, expires within the next second, or already did and is only kept for serve-stale
+                self.policy.miss(key)
+                return None
+            self.policy.hit(key)
+            entry[3] += 1
+            if prefetch is None:
+                return entry[0], remaining
+            fraction, min_hits = prefetch
+            due = entry[3] >= min_hits and entry[1] - now < max(entry[2] * fraction, MIN_PREFETCH_WINDOW)
+            if due:
+                entry[3] = -(1 << 30) # claimed, nobody else prefetches this copy of the entry
+            return entry[0], remaining, due
+
+    def get_stale(self, key):
+        # (value, seconds since it expired) for an expired entry still inside the stale window, None otherwise
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+            entry = self.cache.get(key)
+            if entry is None or int(entry[1] - now) > 0:
+                return None
+            return entry[0], int(now - entry[1])
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+
+    def put(self, key, value, ttl):
+        ttl = min(int(ttl), self.max_ttl)
+        if ttl <= 0:
+            return # ttl 0 means don't cache
+        now = time.monotonic()
+        expires = now + ttl
+        with self.lock:
+            self.expire(now)
+            self.store(key, [value, expires, ttl, 0])
+            heapq.heappush(self.heap, (expires + self.stale_ttl, key))
+
+    def __len__(self):
+        with self.lock:
+            self.expire(time.monotonic())
+            return len(self.cache)
+
+class RRsetCache(TTLCache):
+    # whole rrsets keyed by (owner name, type, class), the values are the dnslib RRs as upstream sent them
+    # every record of a set shares the set's ttl, hits come back as copies carrying the remaining ttl
+    def get_rrset(self, name, rtype, rclass=CLASS.IN, prefetch=None):
+        # ([RR], remaining ttl) or None, ([RR], remaining ttl, due) with prefetch=(fraction, min hits), see get_entry
+        entry = self.get_entry((name, rtype, rclass), prefetch)
+        if entry is None:
+            return None
+        rrs, remaining = entry[0], entry[1]
+        return ([RR(rr.rname, rr.rtype, rr.rclass, remaining, rr.rdata) for rr in rrs], remaining) + entry[2:]
+
+    def get_stale_rrset(self, name, rtype, rclass=CLASS.IN):
+        # like get_rrset, but falls back to an expired rrset inside the stale window, handed out with STALE_ANSWER_TTL
+        fresh = self.get_rrset(name, rtype, rclass)
+        if fresh is not None:
+            return fresh
+        entry = self.get_stale((name, rtype, rclass))
+        if entry is None:
+            return None
+        return [RR(rr.rname, rr.rtype, rr.rclass, STALE_ANSWER_TTL, rr.rdata) for rr in entry[0]], STALE_ANSWER_TTL
+
+    def put_rrset(self, name, rtype, rrs, rclass=CLASS.IN):
+        if rrs:
+            self.put((name, rtype, rclass), list(rrs), min(rr.ttl for rr in rrs))
+
+class RRsetOrder:
+    # order the records of a multi-record answer go out in, so clients spread their load over every backend
+    # "cyclic" rotates by one per query for the same name and type, "random" shuffles, "fixed" keeps upstream's order
+    # only the final rrset of an answer moves, a cname chain in front of it stays put
+    def __init__(self, mode="cyclic", limit=4096):
+        self.mode = mode
+        self.limit = limit # names we keep a rotation counter for, the counters start over past this
+        self.counters = {}
+
+    def apply(self, key, rrs):
+        if self.mode == "fixed" or len(rrs) < 2:
+            return rrs
+        last = rrs[-1]
+        start = len(rrs) - 1
+        while start > 0 and rrs[start - 1].rtype == last.rtype and rrs[start - 1].rname == last.rname:
+            start -= 1
+        head, rrset = rrs[:start], rrs[start:]
+        if len(rrset) < 2:
+            return rrs
+        if self.mode == "random":
+            return head + random.sample(rrset, len(rrset))
+        if len(self.counters) >= self.limit:
+            self.counters = {}
+        n = self.counters.get(key, 0)
+        self.counters[key] = n + 1 # racing threads may hand out the same order twice, harmless
+        n %= len(rrset)
+        return head + rrset[n:] + rrset[:n]
+
+def describe(rrs):
+    # short text for the log's response column: the rdata of the answer's final rrset
+    if not rrs:
+        return None
+    last = rrs[-1]
+    return ",".join(str(rr.rdata) for rr in rrs if rr.rtype == last.rtype and rr.rname == last.rname)
+
+def negative_answer(resp):
+    # (rcode name, soa rr, ttl) if resp says the name (nxdomain) or the type (nodata) doesn't exist, None otherwise
+    # per rfc 2308 the negative ttl is min(soa ttl, soa minimum), no soa means we can answer but not cache it
+    rcode = resp.header.rcode
+    if resp.rr or rcode not in (RCODE.NOERROR, RCODE.NXDOMAIN):
+        return None
+    soa = next((rr for rr in resp.auth if rr.rtype == QTYPE.SOA), None)
+    if rcode == RCODE.NXDOMAIN:
+        if soa is None:
+            return "NXDOMAIN", None, 0
+        return "NXDOMAIN", soa, min(soa.ttl, soa.rdata.times[4], MAX_NEGATIVE_TTL)
+    if soa is None: # no answer and no soa is a referral, not nodata
+        return None
+    return "NODATA", soa, min(soa.ttl, soa.rdata.times[4], MAX_NEGATIVE_TTL)
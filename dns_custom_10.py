@@ -1,113 +1,83 @@
-import socket, time, csv
-from dnslib import DNSRecord, DNSHeader, QTYPE, RR, A
-from collections import OrderedDict
+import socket
+from dnslib import DNSRecord, DNSHeader, CLASS, QTYPE, RCODE
+import workers
+from dns_cache import RRsetCache, RRSET_TYPES, describe
+from query_log import AsyncLogWriter, CsvSink, FIELDS
+from resolver import Resolver, STALE_WINDOW
 
 LISTEN_IP = "10.0.0.5"
 LISTEN_PORT = 53
 CACHE_LIMIT = 400
+CACHE_POLICY = "lru" # or slru / arc / w-tinylfu, see bench_cache.py
 ROOT_SERVERS = ["198.41.0.4","170.247.170.2","192.33.4.12","199.7.91.13","192.203.230.10","192.5.5.241","192.112.36.4","198.97.190.53","192.36.148.17","192.58.128.30","193.0.14.129","199.7.83.42","202.12.27.33"]
 LOG_FILE = "/home/mininet/dns-query-resolution/dns_custom_10.csv"
+LOG_FIELDS = FIELDS[:9] + ["servers_visited"] + FIELDS[9:] # servers_visited stays where it always was in this csv
+WORKERS = 1 # >1 pre-forks workers on the same port with SO_REUSEPORT
+STATS_INTERVAL = 10
 
-class LRUCache:
-    def __init__(self, capacity):
-        self.cache = OrderedDict()
-        self.capacity = capacity
-    def get(self, key):
-        if key in self.cache:
-            self.cache.move_to_end(key)
-            return self.cache[key]
-        return None
-    def put(self, key, value):
-        self.cache[key] = value
-        self.cache.move_to_end(key)
-        if len(self.cache) > self.capacity:
-            self.cache.popitem(last=False)
+engine, query_log = None, None # set up in main()
 
-cache = LRUCache(CACHE_LIMIT)
-
-csv_file = open(LOG_FILE, 'w', newline='')
-csv_writer = csv.DictWriter(csv_file, fieldnames=["timestamp","domain","resolution_mode","server_ip","step","response","rtt","total_time","cache_status","servers_visited"])
-csv_writer.writeheader()
-
-def query_server(domain, server_ip):
-    q = DNSRecord.question(domain)
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.settimeout(3)
-    start = time.time()
-    try:
-        print(f"[>] Querying {server_ip} for {domain}")
-        s.sendto(q.pack(), (server_ip, 53))
-        data, _ = s.recvfrom(512)
-        rtt = time.time() - start
-        resp = DNSRecord.parse(data)
-        print(f"[<] Response from {server_ip} in {rtt:.3f}s")
-        return resp, rtt
-    except socket.timeout:
-        print(f"[x] Timeout {server_ip}")
-        return None, None
-    finally:
-        s.close()
-
-def recursive_resolve(domain):
+def report(domain, answer, logs):
+    # the step by step trace this server always printed, now read back from the engine's log records
     print(f"\n=== Resolving {domain} ===")
-    log_entries, servers_visited = [], 0
-    total_start = time.time()
-    cached = cache.get(domain)
-    if cached:
-        total_time = time.time() - total_start
-        print(f"[CACHE HIT] {domain} → {cached}")
-        log_entries.append({"timestamp":time.strftime("%Y-%m-%d %H:%M:%S"),"domain":domain,"resolution_mode":"Cache","server_ip":"-","step":"Cache","response":cached,"rtt":0,"total_time":round(total_time,4),"cache_status":"HIT","servers_visited":0})
-        return cached, log_entries
-    current_servers = ROOT_SERVERS.copy()
-    response_ip = None
-    for step_name in ["Root","TLD","Authoritative"]:
-        print(f"\n--- {step_name} ---")
-        for server in current_servers:
-            servers_visited += 1
-            resp, rtt = query_server(domain, server)
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            if resp is None:
-                continue
-            answers, additionals = resp.rr, resp.ar
-            if answers:
-                response_ip = str(answers[0].rdata)
-                print(f"[✓] {domain} resolved by {server} ({step_name}) → {response_ip}")
-                total_time = time.time() - total_start
-                log_entries.append({"timestamp":timestamp,"domain":domain,"resolution_mode":"Recursive","server_ip":server,"step":step_name,"response":response_ip,"rtt":round(rtt,4),"total_time":round(total_time,4),"cache_status":"MISS","servers_visited":servers_visited})
-                cache.put(domain, response_ip)
-                return response_ip, log_entries
-            new_servers = [str(rr.rdata) for rr in additionals if rr.rtype == QTYPE.A]
-            if new_servers:
-                print(f"[>] {server} referred to {len(new_servers)}: {', '.join(new_servers)}")
-                log_entries.append({"timestamp":timestamp,"domain":domain,"resolution_mode":"Recursive","server_ip":server,"step":step_name,"response":",".join(new_servers),"rtt":round(rtt,4),"total_time":0,"cache_status":"MISS","servers_visited":servers_visited})
-                current_servers = new_servers
-                break
-    print(f"[!] Failed to resolve {domain}")
-    total_time = time.time() - total_start
-    for e in log_entries: e["total_time"]=round(total_time,4)
-    return response_ip, log_entries
+    for e in logs:
+        if e.cache_status == "HIT":
+            print(f"[CACHE HIT] {domain} → {e.response}")
+        elif e.step == "Coalesced":
+            print(f"[=] joined a walk already in progress → {e.response}")
+        else:
+            print(f"[<] {e.step}: {e.server_ip} answered in {e.rtt:.3f}s → {e.response}")
+    visited = logs[-1].servers_visited if logs else 0 # same count as the csv's servers_visited column
+    if answer:
+        print(f"[✓] {domain} → {describe(answer)}" + (f" ({visited} servers visited)" if visited else ""))
+    else:
+        print(f"[!] Failed to resolve {domain}")
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((LISTEN_IP, LISTEN_PORT))
-print(f"DNS server listening on {LISTEN_IP}:{LISTEN_PORT}")
+worker_id, worker_stats = 0, None
 
-try:
+def serve(sock):
     while True:
         data, addr = sock.recvfrom(512)
         request = DNSRecord.parse(data)
         qname = str(request.q.qname).rstrip('.')
-        ip, logs = recursive_resolve(qname)
-        for e in logs: csv_writer.writerow(e)
-        csv_file.flush()
+        qtype = QTYPE.get(request.q.qtype)
         reply = DNSRecord(DNSHeader(id=request.header.id, qr=1, aa=1, ra=1), q=request.q)
-        if ip:
-            try:
-                reply.add_answer(RR(rname=request.q.qname,rtype=QTYPE.A,rclass=1,ttl=60,rdata=A(ip)))
-            except Exception as ex:
-                print(f"[!] Error creating RR for {ip}: {ex}")
+        if qtype not in RRSET_TYPES or request.q.qclass != CLASS.IN:
+            reply.header.rcode = RCODE.NOTIMP
+            sock.sendto(reply.pack(), addr)
+            continue
+        answer, ttl, negative, logs = engine.resolve(qname, qtype)
+        report(qname, answer, logs)
+        if negative and negative[0] == "NXDOMAIN": reply.header.rcode = RCODE.NXDOMAIN
+        for rr in answer: reply.add_answer(rr)
         sock.sendto(reply.pack(), addr)
-except KeyboardInterrupt:
-    print("\nShutting down")
-finally:
-    csv_file.close()
-    sock.close()
+        if worker_stats is not None: worker_stats.count(worker_id)
+
+def run_worker(wid, stats):
+    global worker_id, worker_stats
+    worker_id, worker_stats = wid, stats
+    try: serve(workers.reuseport_socket(LISTEN_IP, LISTEN_PORT))
+    except KeyboardInterrupt: pass
+    finally: query_log.close()
+
+def main():
+    global engine, query_log
+    query_log = AsyncLogWriter(CsvSink(LOG_FILE, LOG_FIELDS))
+    print(f"DNS server listening on {LISTEN_IP}:{LISTEN_PORT} ({WORKERS} worker(s))")
+    try:
+        if WORKERS > 1:
+            cache_manager, cache = workers.start_shared_cache(lambda: RRsetCache(CACHE_LIMIT, stale_ttl=STALE_WINDOW, policy=CACHE_POLICY))
+            engine = Resolver(ROOT_SERVERS, cache=cache, query_log=query_log, cache_limit=CACHE_LIMIT)
+            workers.run_workers(WORKERS, run_worker, STATS_INTERVAL)
+        else:
+            engine = Resolver(ROOT_SERVERS, query_log=query_log, cache_limit=CACHE_LIMIT, cache_policy=CACHE_POLICY)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((LISTEN_IP, LISTEN_PORT))
+            serve(sock)
+    except KeyboardInterrupt:
+        print("\nShutting down")
+    finally:
+        query_log.close()
+
+if __name__ == "__main__":
+    main()
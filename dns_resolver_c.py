@@ -1,54 +1,99 @@
 import socketserver
-from dnslib import DNSRecord, QTYPE, RR, A
-from collections import OrderedDict
-import dns.resolver  # to forward queries
+import threading
+import time
+from dnslib import DNSRecord, CLASS, QTYPE, RCODE
+from dns_cache import RRsetCache, RRsetOrder, RRSET_TYPES
+from infra_cache import InfraCache
+from upstream import UpstreamPool, tcp_query
 
 CACHE_LIMIT = 400
-cache = OrderedDict()  # LRU cache: domain -> IP
+CACHE_POLICY = "lru"  # eviction: "lru", "slru", "arc" or "w-tinylfu", see bench_cache.py
+cache = RRsetCache(CACHE_LIMIT, policy=CACHE_POLICY)  # (domain, type, class) -> the forwarder's whole answer, expires with its lowest ttl
 
-UPSTREAM_DNS = '8.8.8.8'  # Can forward unresolved queries here
+UPSTREAM_DNS = ['8.8.8.8', '1.1.1.1', '9.9.9.9']  # Forward unresolved queries here, faster ones get picked more often
 PORT = 53
+SERVER_MODE = "threaded"  # "threaded" answers every query on its own thread, "single" is the old one at a time server
+UPSTREAM_SOCKETS = 4  # shared sockets for all forwarded queries
+MAX_TRIES = 3  # forwarders tried per query before giving up (SERVFAIL)
+MIN_TIMEOUT = 1.0  # forwarders recurse on their own misses, so never wait less than this even if their srtt is tiny
+HEALTH_INTERVAL = 10  # seconds between health probes of every forwarder
+RRSET_ORDER = "cyclic"  # multi-record answers: "cyclic" rotates them per query, "random" shuffles, "fixed" as the forwarder sent them
+LAME_RCODES = (RCODE.SERVFAIL, RCODE.REFUSED)
+
+upstream = UpstreamPool(UPSTREAM_SOCKETS)
+infra = InfraCache()  # srtt / rto / backoff per forwarder
+order = RRsetOrder(RRSET_ORDER, CACHE_LIMIT * 4)
+
+def forward(qname, qtype):
+    # (answer rrs, rcode): ask forwarders in latency weighted order, fail over to the next on a timeout or lame answer
+    for server in infra.weighted_order(UPSTREAM_DNS)[:MAX_TRIES]:
+        resp, rtt = upstream.query(qname, server, timeout=max(infra.timeout(server), MIN_TIMEOUT), qtype=qtype)
+        if resp is None:
+            infra.record_failure(server)
+            print(f"Upstream {server} timed out for {qname}")
+            continue
+        if resp.header.rcode in LAME_RCODES:
+            infra.record_failure(server, timed_out=False)
+            continue
+        infra.record_rtt(server, rtt)
+        if resp.header.tc:  # didn't fit in udp, same forwarder over tcp
+            resp = tcp_query(qname, server, timeout=infra.timeout(server), qtype=qtype)[0] or resp
+        return resp.rr, resp.header.rcode  # cname chain + rrset, or nxdomain / nodata that another forwarder would repeat
+    return [], RCODE.SERVFAIL
+
+def health_check():
+    # probes every forwarder, even the backed off ones, so a dead one comes back as soon as it answers again
+    while True:
+        for server in UPSTREAM_DNS:
+            resp, rtt = upstream.query("", server, timeout=infra.timeout(server), qtype="NS")  # ". NS", always in cache
+            if resp is None or resp.header.rcode in LAME_RCODES:
+                infra.record_failure(server, timed_out=resp is None)
+            else:
+                infra.record_rtt(server, rtt)
+        time.sleep(HEALTH_INTERVAL)
 
 class DNSHandler(socketserver.BaseRequestHandler):
     def handle(self):
         data, sock = self.request
         request = DNSRecord.parse(data)
-        qname = str(request.q.qname)
-        qtype = QTYPE[request.q.qtype]
-        
+        qname = str(request.q.qname).rstrip('.').lower()
+        qtype = QTYPE.get(request.q.qtype)
+
         print(f"Query: {qname} Type: {qtype}")
-        
-        # Only handle A records
-        if qtype != "A":
+
+        # Only the types we cache, in class IN
+        if qtype not in RRSET_TYPES or request.q.qclass != CLASS.IN:
             reply = request.reply()
+            reply.header.rcode = RCODE.NOTIMP
             sock.sendto(reply.pack(), self.client_address)
             return
-        
+
         # Check cache
-        if qname in cache:
-            ip = cache[qname]
+        rcode = RCODE.NOERROR
+        cached = cache.get_rrset(qname, request.q.qtype)
+        if cached:
+            answer = cached[0]
             print("Cache HIT")
         else:
             print("Cache MISS")
-            try:
-                # Forward query to upstream DNS
-                answer = dns.resolver.resolve(qname, 'A')
-                ip = answer[0].to_text()
-                # Add to cache
-                cache[qname] = ip
-                # Enforce cache limit
-                if len(cache) > CACHE_LIMIT:
-                    cache.popitem(last=False)  # Remove oldest
-            except Exception as e:
-                print(f"Failed to resolve {qname}: {e}")
-                ip = None
-        
+            answer, rcode = forward(qname, qtype)
+            if answer:
+                cache.put_rrset(qname, request.q.qtype, answer)
+            else:
+                print(f"Failed to resolve {qname}: {RCODE[rcode]}")
+
         reply = request.reply()
-        if ip:
-            reply.add_answer(RR(qname, QTYPE.A, rdata=A(ip), ttl=300))
+        reply.header.rcode = rcode
+        for rr in order.apply((qname, qtype), answer):
+            reply.add_answer(rr)
         sock.sendto(reply.pack(), self.client_address)
 
+class ThreadedUDPServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    daemon_threads = True  # one thread per query, a slow forwarder only holds up its own queries
+
 if __name__ == "__main__":
-    print("Starting Custom DNS Resolver on port 53")
-    server = socketserver.UDPServer(("", PORT), DNSHandler)
+    print(f"Starting Custom DNS Resolver on port {PORT} ({SERVER_MODE}, forwarders: {', '.join(UPSTREAM_DNS)})")
+    threading.Thread(target=health_check, daemon=True).start()
+    server_class = ThreadedUDPServer if SERVER_MODE == "threaded" else socketserver.UDPServer
+    server = server_class(("", PORT), DNSHandler)
     server.serve_forever()
@@ -0,0 +1,225 @@
+from collections import OrderedDict
+# eviction policies for the answer caches in dns_cache.py
+# the cache keeps the values, a policy only keeps keys and decides which of them goes when the cache is full:
+#   hit(key)     key is cached and was just read (or overwritten)
+#   miss(key)    key was looked up and isn't cached
+#   add(key)     key was just stored, returns the keys to drop (can include key itself if the policy won't admit it)
+#   remove(key)  key left the cache for another reason (expired)
+# callers hold the cache's lock, so none of these lock anything themselves
+
+class LRUPolicy: # least recently used goes first
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.order = OrderedDict()
+
+    def __len__(self):
+        return len(self.order)
+
+    def hit(self, key):
+        self.order.move_to_end(key)
+
+    def miss(self, key):
+        pass
+
+    def add(self, key):
+        self.order[key] = None
+        if len(self.order) > self.capacity:
+            return [self.order.popitem(last=False)[0]]
+        return []
+
+    def remove(self, key):
+        self.order.pop(key, None)
+
+class SLRUPolicy:
+    # segmented lru: new keys start on probation and a second hit promotes them to the protected segment,
+    # so a burst of names asked for once only churns probation and never pushes out the names asked for again and again
+    def __init__(self, capacity, protected_share=0.8):
+        self.capacity = capacity
+        self.protected_capacity = int(capacity * protected_share)
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
+
+    def hit(self, key):
+        if key in self.protected:
+            self.protected.move_to_end(key)
+            return
+        del self.probation[key]
+        self.protected[key] = None
+        if len(self.protected) > self.protected_capacity: # oldest protected key gets another chance on probation
+            self.probation[self.protected.popitem(last=False)[0]] = None
+
+    def miss(self, key):
+        pass
+
+    def victim(self):
+        # the key the next add() into a full cache would drop
+        if self.probation:
+            return next(iter(self.probation))
+        if self.protected:
+            return next(iter(self.protected))
+        return None
+
+    def add(self, key):
+        self.probation[key] = None
+        if len(self) <= self.capacity:
+            return []
+        victim = self.victim()
+        self.remove(victim)
+        return [victim]
+
+    def remove(self, key):
+        if key in self.probation:
+            del self.probation[key]
+        else:
+            self.protected.pop(key, None)
+
+class ARCPolicy:
+    # adaptive replacement cache (megiddo & modha, fast 2003)
+    # t1 holds keys seen once recently, t2 keys seen at least twice, b1 / b2 remember keys recently dropped from each,
+    # a miss that would have been a hit in t1 with a bigger t1 (a b1 ghost) grows t1's target p, a b2 ghost shrinks it
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.p = 0 # target size of t1
+        self.t1, self.t2 = OrderedDict(), OrderedDict()
+        self.b1, self.b2 = OrderedDict(), OrderedDict() # ghosts, keys only, the values are already gone
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def hit(self, key):
+        if key in self.t1:
+            del self.t1[key]
+            self.t2[key] = None
+        else:
+            self.t2.move_to_end(key)
+
+    def miss(self, key):
+        pass
+
+    def replace(self, key):
+        # frees one slot from t1 or t2 (towards p) into the matching ghost list, nothing if the cache isn't full
+        if len(self) < self.capacity:
+            return []
+        if self.t1 and (len(self.t1) > self.p or (key in self.b2 and len(self.t1) == self.p) or not self.t2):
+            old = self.t1.popitem(last=False)[0]
+            self.b1[old] = None
+        else:
+            old = self.t2.popitem(last=False)[0]
+            self.b2[old] = None
+        return [old]
+
+    def add(self, key):
+        c = self.capacity
+        if key in self.b1: # dropped from t1 too early, give t1 more room
+            self.p = min(c, self.p + max(len(self.b2) // max(len(self.b1), 1), 1))
+            evicted = self.replace(key)
+            del self.b1[key]
+            self.t2[key] = None
+            return evicted
+        if key in self.b2: # dropped from t2 too early, give t2 more room
+            self.p = max(0, self.p - max(len(self.b1) // max(len(self.b2), 1), 1))
+            evicted = self.replace(key)
+            del self.b2[key]
+            self.t2[key] = None
+            return evicted
+        evicted = []
+        if len(self.t1) + len(self.b1) >= c:
+            if len(self.t1) < c:
+                self.b1.popitem(last=False)
+                evicted = self.replace(key)
+            else: # t1 alone fills the cache, drop its lru key without keeping a ghost
+                evicted = [self.t1.popitem(last=False)[0]]
+        elif len(self) + len(self.b1) + len(self.b2) >= c:
+            if len(self) + len(self.b1) + len(self.b2) >= 2 * c:
+                self.b2.popitem(last=False)
+            evicted = self.replace(key)
+        self.t1[key] = None
+        return evicted
+
+    def remove(self, key):
+        if key in self.t1:
+            del self.t1[key]
+        else:
+            self.t2.pop(key, None)
+
+class FrequencySketch:
+    # count-min sketch of how often each key was asked for, 4 rows of counters that saturate at 15
+    # every counter is halved once 10 x capacity increments went in, so yesterday's popular names fade out (tinylfu aging)
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+
+    def __init__(self, capacity):
+        width = 16
+        while width < 2 * capacity:
+            width *= 2
+        self.mask = width - 1
+        self.rows = [[0] * width for _ in self.SEEDS]
+        self.sample = 10 * max(capacity, 1)
+        self.additions = 0
+
+    def indexes(self, key):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return [(((h * seed) & 0xFFFFFFFFFFFFFFFF) >> 40) & self.mask for seed in self.SEEDS]
+
+    def increment(self, key):
+        for row, i in zip(self.rows, self.indexes(key)):
+            if row[i] < 15:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample:
+            self.rows = [[n >> 1 for n in row] for row in self.rows]
+            self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self.indexes(key)))
+
+class WTinyLFUPolicy:
+    # w-tinylfu (einziger, friedman & manes 2017): new keys land in a small lru window (1% of the cache),
+    # a key leaving the window only gets into the main slru if it was asked for more often than the key it would push out,
+    # so one-hit wonders wash through the window while the main cache keeps the names that keep coming back
+    def __init__(self, capacity, window_share=0.01):
+        self.window_capacity = max(1, int(capacity * window_share))
+        self.window = OrderedDict()
+        self.main = SLRUPolicy(max(capacity - self.window_capacity, 0))
+        self.sketch = FrequencySketch(capacity)
+
+    def __len__(self):
+        return len(self.window) + len(self.main)
+
+    def hit(self, key):
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+        else:
+            self.main.hit(key)
+
+    def miss(self, key):
+        self.sketch.increment(key)
+
+    def add(self, key):
+        self.window[key] = None
+        if len(self.window) <= self.window_capacity:
+            return []
+        candidate = self.window.popitem(last=False)[0]
+        if len(self.main) < self.main.capacity: # main isn't full yet, no contest
+            return self.main.add(candidate)
+        victim = self.main.victim()
+        if victim is not None and self.sketch.estimate(candidate) > self.sketch.estimate(victim):
+            return self.main.add(candidate) # drops victim
+        return [candidate]
+
+    def remove(self, key):
+        if key in self.window:
+            del self.window[key]
+        else:
+            self.main.remove(key)
+
+POLICIES = {"lru": LRUPolicy, "slru": SLRUPolicy, "arc": ARCPolicy, "w-tinylfu": WTinyLFUPolicy}
+
+def make_policy(name, capacity):
+    try:
+        return POLICIES[name](capacity)
+    except KeyError:
+        raise ValueError(f"unknown cache policy {name!r}, pick one of {', '.join(POLICIES)}") from None
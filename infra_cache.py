@@ -0,0 +1,130 @@
+import random
+import threading
+import time
+from collections import deque
+# infrastructure cache: what we know about each upstream server ip
+# keeps a smoothed rtt and rtt variance per server (rfc 6298 style) and turns them into a retransmission timeout,
+# orders servers by expected latency, and backs off servers that time out or answer lame
+
+UNKNOWN_RTT = 0.376 # expected rtt for servers we never talked to, low enough that they get tried
+MIN_RTO = 0.2
+MAX_RTO = 3.0 # the old fixed timeout is now the ceiling
+EXPLORE = 0.1 # chance of trying a random server first instead of the fastest, so new measurements keep coming in
+BASE_BACKOFF = 1.0 # seconds a server is skipped after its first failure, doubles each time it fails again
+MAX_BACKOFF = 300.0
+
+class ServerStats:
+    __slots__ = ("srtt", "rttvar", "rto", "failures", "backoff_until", "timeouts")
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = MAX_RTO
+        self.failures = 0 # consecutive timeouts / lame answers
+        self.backoff_until = 0
+        self.timeouts = 0 # all time, for reporting
+
+class InfraCache:
+    def __init__(self, explore=EXPLORE):
+        self.explore = explore
+        self.servers = {} # ip -> ServerStats
+        self.lock = threading.Lock()
+
+    def stats(self, ip):
+        s = self.servers.get(ip)
+        if s is None:
+            s = self.servers[ip] = ServerStats()
+        return s
+
+    def timeout(self, ip):
+        with self.lock:
+            return self.stats(ip).rto
+
+    def record_rtt(self, ip, rtt):
+        with self.lock:
+            s = self.stats(ip)
+            if s.srtt is None: # first sample
+                s.srtt, s.rttvar = rtt, rtt / 2
+            else:
+                s.rttvar = 0.75 * s.rttvar + 0.25 * abs(s.srtt - rtt)
+                s.srtt = 0.875 * s.srtt + 0.125 * rtt
+            s.rto = min(max(s.srtt + 4 * s.rttvar, MIN_RTO), MAX_RTO)
+            s.failures = 0
+            s.backoff_until = 0
+
+    def record_failure(self, ip, timed_out=True):
+        # timeouts also double the rto, lame answers (servfail, refused) only back off
+        with self.lock:
+            s = self.stats(ip)
+            s.failures += 1
+            if timed_out:
+                s.timeouts += 1
+                s.rto = min(s.rto * 2, MAX_RTO)
+            s.backoff_until = time.time() + min(BASE_BACKOFF * 2 ** (s.failures - 1), MAX_BACKOFF)
+
+    def expected_rtt(self, s):
+        return UNKNOWN_RTT if s.srtt is None else s.srtt
+
+    def order(self, servers):
+        # fastest expected first, servers in backoff go last (still tried if nobody else answers)
+        now = time.time()
+        with self.lock:
+            live, backed_off = [], []
+            for ip in servers:
+                s = self.stats(ip)
+                if s.backoff_until > now:
+                    backed_off.append((s.backoff_until, ip))
+                else:
+                    live.append((self.expected_rtt(s), ip))
+        live.sort()
+        backed_off.sort()
+        ordered = [ip for _, ip in live]
+        if len(ordered) > 1 and random.random() < self.explore:
+            ordered.insert(0, ordered.pop(random.randrange(1, len(ordered))))
+        return ordered + [ip for _, ip in backed_off]
+
+    def weighted_order(self, servers):
+        # random order biased towards fast servers (chance proportional to 1 / expected rtt), backed off servers last
+        # spreads load over every healthy server instead of always hammering the fastest one
+        now = time.time()
+        with self.lock:
+            live, backed_off = [], []
+            for ip in servers:
+                s = self.stats(ip)
+                if s.backoff_until > now:
+                    backed_off.append((s.backoff_until, ip))
+                else:
+                    live.append((1 / max(self.expected_rtt(s), 0.001), ip))
+        ordered = []
+        while live:
+            pick = random.random() * sum(w for w, _ in live)
+            for i, (w, ip) in enumerate(live):
+                pick -= w
+                if pick <= 0 or i == len(live) - 1:
+                    ordered.append(live.pop(i)[1])
+                    break
+        backed_off.sort()
+        return ordered + [ip for _, ip in backed_off]
+
+    def snapshot(self):
+        with self.lock:
+            return {ip: (s.srtt, s.rttvar, s.rto, s.failures, s.timeouts) for ip, s in self.servers.items()}
+
+class LatencyWindow:
+    # recent rtts of one resolution step, used to pick the hedging delay from a percentile
+    def __init__(self, size=256, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, rtt):
+        with self.lock:
+            self.samples.append(rtt)
+
+    def percentile(self, p):
+        # None until we have enough samples to trust
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
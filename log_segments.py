@@ -0,0 +1,192 @@
+import csv
+import glob
+import os
+import struct
+import sys
+import time
+import zlib
+from query_log import FIELDS
+# columnar query log: rotated, zlib compressed segment files instead of one ever-growing csv
+# every batch from the log writer becomes one block, the columns of a block are stored one after the other
+# (strings dictionary encoded, numbers packed as doubles) and compressed together
+# each block starts with a small index: its time range and the sorted set of domains in it,
+# so a reader looking for one domain / time window only decompresses the blocks that can match
+#
+# block layout:  header (BLOCK_HEADER) | zlib(domain index) | zlib(columns)
+# columns:       for each string column: count of distinct values, the values, then one index per row
+#                for each number column: one double per row
+
+MAGIC = b"QLB1"
+BLOCK_HEADER = struct.Struct("!4sddIII") # magic, first timestamp, last timestamp, rows, index bytes, body bytes
+STRING_COLUMNS = ["domain", "resolution_mode", "server_ip", "step", "response", "cache_status", "zone_cut"]
+NUMBER_COLUMNS = ["timestamp", "rtt", "total_time"]
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+epoch_memo = {} # log records carry strftime strings, consecutive records nearly always share one
+
+def to_epoch(timestamp):
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    epoch = epoch_memo.get(timestamp)
+    if epoch is None:
+        if len(epoch_memo) > 64:
+            epoch_memo.clear()
+        epoch = epoch_memo[timestamp] = time.mktime(time.strptime(timestamp, TIME_FORMAT))
+    return epoch
+
+def pack_strings(values):
+    distinct = {}
+    ids = [distinct.setdefault(v, len(distinct)) for v in values]
+    out = [struct.pack("!I", len(distinct))]
+    for v in distinct:
+        raw = v.encode("utf-8")
+        out.append(struct.pack("!H", len(raw)) + raw)
+    out.append(struct.pack(f"!{len(ids)}I", *ids))
+    return b"".join(out)
+
+def unpack_strings(body, pos, rows):
+    (count,) = struct.unpack_from("!I", body, pos)
+    pos += 4
+    distinct = []
+    for _ in range(count):
+        (n,) = struct.unpack_from("!H", body, pos)
+        distinct.append(body[pos + 2:pos + 2 + n].decode("utf-8"))
+        pos += 2 + n
+    ids = struct.unpack_from(f"!{rows}I", body, pos)
+    return [distinct[i] for i in ids], pos + 4 * rows
+
+def pack_block(records):
+    times = [to_epoch(r.timestamp) for r in records]
+    columns = []
+    for name in STRING_COLUMNS:
+        columns.append(pack_strings(["" if getattr(r, name) is None else str(getattr(r, name)) for r in records]))
+    columns.append(struct.pack(f"!{len(times)}d", *times))
+    for name in NUMBER_COLUMNS[1:]:
+        columns.append(struct.pack(f"!{len(records)}d", *(float(getattr(r, name) or 0) for r in records)))
+    domains = sorted({r.domain.lower() for r in records})
+    index = zlib.compress("\n".join(domains).encode("utf-8"))
+    body = zlib.compress(b"".join(columns))
+    return BLOCK_HEADER.pack(MAGIC, min(times), max(times), len(records), len(index), len(body)) + index + body
+
+def unpack_block(body, rows):
+    body = zlib.decompress(body)
+    pos = 0
+    columns = {}
+    for name in STRING_COLUMNS:
+        columns[name], pos = unpack_strings(body, pos, rows)
+    for name in NUMBER_COLUMNS:
+        columns[name] = struct.unpack_from(f"!{rows}d", body, pos)
+        pos += 8 * rows
+    return columns
+
+class SegmentSink: # drop-in for query_log.CsvSink
+    def __init__(self, directory, prefix="dns_log", max_bytes=16 << 20, max_seconds=3600, keep=48):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes # a segment is closed once it grows past this
+        self.max_seconds = max_seconds # or once it is this old
+        self.keep = keep # oldest segments are deleted beyond this many, 0 keeps everything
+        self.file = None
+        self.opened = 0
+        self.pid = None
+        self.seq = 0 # segments opened by this process, keeps names unique when two rotations land in the same millisecond
+        os.makedirs(directory, exist_ok=True)
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+        # one file per process and start time, forked workers never share a segment and a rotation never reopens one
+        if self.pid != os.getpid():
+            self.seq = 0
+        self.seq += 1
+        now = time.time()
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + f".{int(now * 1000) % 1000:03d}"
+        name = f"{self.prefix}-{stamp}-{os.getpid()}-{self.seq:06d}.qlog"
+        self.file = open(os.path.join(self.directory, name), 'ab')
+        self.opened = now
+        self.pid = os.getpid()
+        if self.keep:
+            for old in segment_files(self.directory, self.prefix)[:-self.keep]:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    def write(self, records):
+        if (self.file is None or self.pid != os.getpid() or self.file.tell() >= self.max_bytes
+                or time.time() - self.opened >= self.max_seconds):
+            self.rotate()
+        self.file.write(pack_block(records))
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None and self.pid == os.getpid():
+            self.file.close()
+        self.file = None
+
+def segment_files(directory, prefix="dns_log"):
+    # oldest first, the timestamp in the name sorts the right way
+    return sorted(glob.glob(os.path.join(directory, f"{prefix}-*.qlog")), key=os.path.basename)
+
+def read_segment(path, domain=None, since=None, until=None):
+    # yields rows as dicts (FIELDS keys), only decompressing blocks whose index says they can match
+    domain = domain.lower().rstrip('.') if domain else None
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                return # end of file (or a block cut short by a crash)
+            magic, first, last, rows, index_len, body_len = BLOCK_HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ValueError(f"{path}: not a query log segment")
+            if (since is not None and last < since) or (until is not None and first > until):
+                f.seek(index_len + body_len, os.SEEK_CUR)
+                continue
+            index = f.read(index_len)
+            if domain is not None and domain not in zlib.decompress(index).decode("utf-8").split("\n"):
+                f.seek(body_len, os.SEEK_CUR)
+                continue
+            body = f.read(body_len)
+            if len(body) < body_len:
+                return
+            columns = unpack_block(body, rows)
+            for i in range(rows):
+                ts = columns["timestamp"][i]
+                if (since is not None and ts < since) or (until is not None and ts > until):
+                    continue
+                if domain is not None and columns["domain"][i].lower() != domain:
+                    continue
+                row = {name: columns[name][i] for name in FIELDS}
+                row["timestamp"] = time.strftime(TIME_FORMAT, time.localtime(ts))
+                yield row
+
+def read_segments(directory, domain=None, since=None, until=None, prefix="dns_log"):
+    for path in segment_files(directory, prefix):
+        yield from read_segment(path, domain, since, until)
+
+def read_csv(path, domain=None, since=None, until=None):
+    # same rows from an old style dns_log.csv, streamed instead of loaded whole
+    domain = domain.lower().rstrip('.') if domain else None
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            if domain is not None and row["domain"].lower() != domain:
+                continue
+            if since is not None or until is not None:
+                ts = to_epoch(row["timestamp"])
+                if (since is not None and ts < since) or (until is not None and ts > until):
+                    continue
+            yield row
+
+if __name__ == "__main__":
+    # python log_segments.py <segment dir or csv> [domain] [last n seconds], prints matching rows as csv
+    source = sys.argv[1]
+    domain = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != "-" else None
+    since = time.time() - float(sys.argv[3]) if len(sys.argv) > 3 else None
+    rows = read_segments(source, domain, since) if os.path.isdir(source) else read_csv(source, domain, since)
+    out = csv.DictWriter(sys.stdout, fieldnames=FIELDS)
+    out.writeheader()
+    for row in rows:
+        out.writerow(row)
@@ -0,0 +1,189 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+# live metrics for the resolver, served as prometheus text on a small http endpoint
+# everything on the query path is an increment under a short lock, the formatting only happens when someone scrapes
+
+SUB_BUCKET_BITS = 4 # 16 linear buckets per power of two, any value is off by at most 1/16
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+def bucket_index(us):
+    if us < SUB_BUCKETS:
+        return us
+    shift = us.bit_length() - SUB_BUCKET_BITS - 1
+    return ((shift + 1) << SUB_BUCKET_BITS) + (us >> shift) - SUB_BUCKETS
+
+def bucket_upper(i):
+    # first microsecond value past bucket i
+    if i < SUB_BUCKETS:
+        return i + 1
+    shift = (i >> SUB_BUCKET_BITS) - 1
+    return (SUB_BUCKETS + (i & (SUB_BUCKETS - 1)) + 1) << shift
+
+class Histogram:
+    # log-linear buckets in the style of HdrHistogram, in microseconds from 1 us up to max_seconds
+    # recording is an index computation and an increment, percentiles come out within ~6%
+    def __init__(self, max_seconds=60):
+        self.max_us = int(max_seconds * 1e6)
+        self.counts = [0] * (bucket_index(self.max_us) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        i = bucket_index(min(max(int(seconds * 1e6), 0), self.max_us))
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.count, self.sum
+
+def percentile(counts, total, p):
+    # upper edge (seconds) of the bucket holding the p-th value
+    if not total:
+        return 0.0
+    rank = max(int(p * total + 0.5), 1)
+    seen = 0
+    for i, n in enumerate(counts):
+        seen += n
+        if seen >= rank:
+            return bucket_upper(i) / 1e6
+    return bucket_upper(len(counts) - 1) / 1e6
+
+class RateMeter:
+    # events per second over the last `window` full seconds, one slot per second in a ring
+    def __init__(self, window=10):
+        self.window = window
+        self.slots = [0] * (window + 1)
+        self.seconds = [0] * (window + 1)
+        self.lock = threading.Lock()
+
+    def mark(self, n=1):
+        now = int(time.monotonic())
+        i = now % len(self.slots)
+        with self.lock:
+            if self.seconds[i] != now:
+                self.seconds[i], self.slots[i] = now, 0
+            self.slots[i] += n
+
+    def rate(self):
+        now = int(time.monotonic())
+        with self.lock: # the current second is still filling up, leave it out
+            total = sum(n for n, s in zip(self.slots, self.seconds) if now - self.window <= s < now)
+        return total / self.window
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+class Metrics:
+    def __init__(self, quantiles=(0.5, 0.9, 0.99, 0.999)):
+        self.quantiles = quantiles
+        self.counters = {} # (name, labels tuple) -> value
+        self.histograms = [] # (name, labels, Histogram)
+        self.collectors = [] # (name, type, fn), fn returns a number or [(labels dict, number)], called on scrape
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def counter_values(self, name):
+        # {labels dict as a tuple: value} for every series of one counter
+        with self.lock:
+            return {labels: n for (key, labels), n in self.counters.items() if key == name}
+
+    def histogram(self, name, help_text, max_seconds=60, **labels):
+        h = Histogram(max_seconds)
+        self.histograms.append((name, labels, h))
+        self.help[name] = help_text
+        return h
+
+    def collect(self, name, kind, help_text, fn):
+        self.collectors.append((name, kind, fn))
+        self.help[name] = help_text
+
+    def describe(self, name, help_text):
+        self.help[name] = help_text
+
+    def render(self):
+        lines = []
+        typed = set()
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{label_text(dict(labels))} {value}")
+        for name, kind, fn in self.collectors:
+            value = fn()
+            header(name, kind)
+            if isinstance(value, list):
+                for labels, v in value:
+                    lines.append(f"{name}{label_text(labels)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+        families = {} # name -> [(labels, counts, total, sum)], a family's lines have to stay together
+        for name, labels, h in self.histograms:
+            families.setdefault(name, []).append((labels,) + h.snapshot())
+        for name, series in families.items():
+            header(name, "histogram")
+            for labels, counts, total, total_sum in series:
+                # prometheus buckets at every power of two from 128 us, the fine buckets only feed the quantiles
+                cumulative = 0
+                for i, n in enumerate(counts):
+                    cumulative += n
+                    if (i + 1) % SUB_BUCKETS == 0 and bucket_upper(i) >= 128:
+                        lines.append(f"{name}_bucket{label_text(dict(labels, le=f'{bucket_upper(i) / 1e6:g}'))} {cumulative}")
+                lines.append(f"{name}_bucket{label_text(dict(labels, le='+Inf'))} {total}")
+                lines.append(f"{name}_sum{label_text(labels)} {total_sum:.6f}")
+                lines.append(f"{name}_count{label_text(labels)} {total}")
+            header(f"{name}_quantile", "gauge")
+            for labels, counts, total, _ in series:
+                for q in self.quantiles:
+                    lines.append(f"{name}_quantile{label_text(dict(labels, quantile=f'{q:g}'))} {percentile(counts, total, q):.6f}")
+        return "\n".join(lines) + "\n"
+
+def serve_metrics(metrics, ip, port, routes=None):
+    # GET /metrics on its own thread, never touches the dns event loop
+    # routes adds more paths: path -> fn(query params dict) returning (content type, body bytes)
+    routes = routes or {}
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/metrics":
+                content_type, body = "text/plain; version=0.0.4", metrics.render().encode()
+            elif url.path in routes:
+                try:
+                    content_type, body = routes[url.path](dict(parse_qsl(url.query)))
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): # no line on stderr for every scrape
+            pass
+
+    server = ThreadingHTTPServer((ip, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
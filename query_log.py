@@ -0,0 +1,117 @@
+import csv
+import os
+import threading
+from collections import deque
+# query logging off the request path
+# handlers drop LogRecords into a bounded buffer, a background thread writes them out in batches
+# and flushes when a batch fills up or every flush_interval seconds, whichever comes first
+
+FIELDS = ["timestamp", "domain", "resolution_mode", "server_ip", "step", "response", "rtt", "total_time", "cache_status", "zone_cut"]
+
+class LogRecord: # one row of the query log, slots instead of a dict per step
+    __slots__ = tuple(FIELDS) + ("servers_visited",) # servers_visited only goes in logs that ask for it (dns_custom_10)
+
+    def __init__(self, timestamp, domain, resolution_mode, server_ip, step, response, rtt, total_time, cache_status, zone_cut="",
+                 servers_visited=0):
+        self.timestamp = timestamp
+        self.domain = domain
+        self.resolution_mode = resolution_mode
+        self.server_ip = server_ip
+        self.step = step
+        self.response = response
+        self.rtt = rtt
+        self.total_time = total_time
+        self.cache_status = cache_status
+        self.zone_cut = zone_cut
+        self.servers_visited = servers_visited # servers asked so far in this walk, timeouts included
+
+    def row(self):
+        return [self.timestamp, self.domain, self.resolution_mode, self.server_ip, self.step,
+                self.response, self.rtt, self.total_time, self.cache_status, self.zone_cut]
+
+class CsvSink: # same csv as before, same columns (or the LogRecord attributes in fields, in that order)
+    def __init__(self, path, fields=FIELDS):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.fields = fields
+        self.writer.writerow(fields)
+        self.file.flush()
+
+    def write(self, records):
+        if self.fields is FIELDS:
+            self.writer.writerows(r.row() for r in records)
+        else:
+            self.writer.writerows([getattr(r, f) for f in self.fields] for r in records)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class AsyncLogWriter:
+    def __init__(self, sink, capacity=65536, batch_size=512, flush_interval=1.0, policy="drop"):
+        self.sink = sink
+        self.capacity = capacity # max records waiting to be written
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy # "drop": full buffer drops new records, "block": the handler waits for room
+        self.buffer = deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.written = 0
+        self.closed = False
+        self.thread = None
+        self.pid = None # writer thread is started lazily, and again in each forked worker
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.cond:
+            if self.pid == os.getpid():
+                return
+            self.buffer.clear() # anything here was copied from the parent, it writes its own
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def write(self, records):
+        self.ensure_started()
+        with self.cond:
+            for record in records:
+                if len(self.buffer) >= self.capacity:
+                    if self.policy != "block":
+                        self.dropped += 1
+                        continue
+                    while len(self.buffer) >= self.capacity and not self.closed:
+                        self.cond.wait()
+                self.buffer.append(record)
+            if len(self.buffer) >= self.batch_size:
+                self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                if len(self.buffer) < self.batch_size and not self.closed:
+                    self.cond.wait(self.flush_interval)
+                batch = list(self.buffer)
+                self.buffer.clear()
+                closing = self.closed
+                self.cond.notify_all() # wake handlers blocked on a full buffer
+            if batch:
+                try:
+                    self.sink.write(batch)
+                    self.sink.flush()
+                    self.written += len(batch)
+                except Exception as e:
+                    print(f"query log write failed, lost {len(batch)} records: {e}")
+            if closing:
+                return
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join()
+        self.sink.close()
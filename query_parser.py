@@ -0,0 +1,95 @@
+import struct
+# minimal decoder for incoming queries: header, the single question and an optional OPT record
+# works on a memoryview of the packet and only builds the qname string, everything else stays as ints
+# anything unusual (several questions, compression in the question, odd opcodes, extra records) returns None
+# so the caller can fall back to a full DNSRecord.parse
+
+OPT = 41
+
+class MalformedQuery(ValueError):
+    pass
+
+class ParsedQuery:
+    __slots__ = ("txid", "flags", "qname", "qtype", "qclass", "q_end", "edns_size", "edns_version", "do")
+
+    def __init__(self, txid, flags, qname, qtype, qclass, q_end, edns_size=None, edns_version=0, do=False):
+        self.txid = txid
+        self.flags = flags
+        self.qname = qname # as the client spelled it, no trailing dot
+        self.qtype = qtype
+        self.qclass = qclass
+        self.q_end = q_end # offset just past the question, data[12:q_end] is the question section
+        self.edns_size = edns_size # udp payload size from the OPT record, None without EDNS
+        self.edns_version = edns_version
+        self.do = do
+
+    @property
+    def rd(self):
+        return self.flags & 0x0100 != 0
+
+def parse_query(data):
+    mv = memoryview(data)
+    n = len(mv)
+    if n < 12:
+        raise MalformedQuery("shorter than a dns header")
+    txid, flags, qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHHHH", mv, 0)
+    if flags & 0x8000 or flags & 0x7800 or qdcount != 1 or ancount or nscount or arcount > 1:
+        return None # a response, a non-QUERY opcode or extra sections
+    pos = 12
+    while True:
+        if pos >= n:
+            raise MalformedQuery("question name runs past the end")
+        length = mv[pos]
+        if length == 0:
+            break
+        if length & 0xC0:
+            return None # compression pointer in a question is legal-ish, let dnslib deal with it
+        pos += length + 1
+        if pos - 12 > 255:
+            raise MalformedQuery("question name longer than 255 bytes")
+    name_end = pos
+    pos += 1
+    if pos + 4 > n:
+        raise MalformedQuery("question truncated")
+    qtype, qclass = struct.unpack_from("!HH", mv, pos)
+    pos += 4
+    q_end = pos
+    edns_size, edns_version, do = None, 0, False
+    if arcount:
+        if pos + 11 > n:
+            raise MalformedQuery("additional record truncated")
+        if mv[pos] != 0:
+            return None # not an OPT (OPT is always owned by the root name), full parse
+        rtype, udp_size, ttl, rdlen = struct.unpack_from("!HHIH", mv, pos + 1)
+        if rtype != OPT:
+            return None
+        if pos + 11 + rdlen > n:
+            raise MalformedQuery("OPT rdata truncated")
+        edns_size = max(udp_size, 512) # rfc 6891, values below 512 are treated as 512
+        edns_version = (ttl >> 16) & 0xFF
+        do = bool(ttl & 0x8000)
+    # qname: turn the length bytes into dots, one copy and one decode
+    raw = bytearray(mv[12:name_end])
+    if 0x2E in raw:
+        return None # might be a dot inside a label, dnslib escapes those properly
+    i = 0
+    while i < len(raw):
+        length = raw[i]
+        raw[i] = 0x2E
+        i += length + 1
+    try:
+        qname = raw[1:].decode("ascii")
+    except UnicodeDecodeError:
+        return None
+    return ParsedQuery(txid, flags, qname, qtype, qclass, q_end, edns_size, edns_version, do)
+
+def from_record(record):
+    # ParsedQuery for a packet that needed the full dnslib parse, q_end is None so it never goes in the wire cache
+    edns_size, edns_version, do = None, 0, False
+    for rr in record.ar:
+        if rr.rtype == OPT:
+            edns_size = max(rr.rclass, 512)
+            edns_version = (rr.ttl >> 16) & 0xFF
+            do = bool(rr.ttl & 0x8000)
+    return ParsedQuery(record.header.id, record.header.bitmap, str(record.q.qname).rstrip('.'),
+                       record.q.qtype, record.q.qclass, None, edns_size, edns_version, do)
@@ -0,0 +1,498 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait, as_completed, FIRST_COMPLETED
+from dnslib import QTYPE, RCODE
+from dns_cache import TTLCache, RRsetCache, RRsetOrder, MAX_TTL, describe, negative_answer
+from singleflight import SingleFlight
+from upstream import UpstreamPool, tcp_query
+from delegation import DelegationCache, parse_referral, in_bailiwick
+from infra_cache import InfraCache, LatencyWindow
+from query_log import LogRecord
+# the recursive resolution engine, without any listening socket
+# everything it keeps state in (caches, infra cache, upstream sockets, the query log) can be passed in,
+# so the servers share one engine with their own config and anything else can import it and call resolve() directly
+#
+#   engine = Resolver()
+#   answer, ttl, negative, logs = engine.resolve("example.com", "AAAA") # answer is the list of RRs, cname chain first
+#   for name, (answer, ttl, negative, logs) in engine.resolve_many(names): ...
+
+ROOT_SERVERS = ["198.41.0.4", "170.247.170.2", "192.33.4.12", "199.7.91.13",
+                "192.203.230.10", "192.5.5.241", "192.112.36.4", "198.97.190.53",
+                "192.36.148.17", "192.58.128.30", "193.0.14.129", "199.7.83.42",
+                "202.12.27.33"]
+STEPS = ["Root", "TLD", "Authoritative"]
+LAME_RCODES = (RCODE.SERVFAIL, RCODE.NOTIMP, RCODE.REFUSED) # server answered but can't help us
+MAX_NS_DEPTH = 4 # glueless ns lookups nested inside each other before we give up on a referral
+NS_TIMEOUT = 6.0 # seconds to wait for any ns name of a glueless referral to resolve
+MAX_CNAME_CHAIN = 8 # cname links followed for one query before we call it a loop and give up
+STALE_WINDOW = 86400 # default serve-stale window, rfc 8767 suggests 1 to 3 days
+
+def now_stamp():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+class TokenBucket: # rate / second on average, bursts of up to `burst`
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class Resolver:
+    def __init__(self, root_servers=None, cache=None, neg_cache=None, infra=None, delegations=None, upstream=None,
+                 query_log=None, tracer=None, step_time=None, cache_limit=400, hedge_mode="hedge",
+                 hedge_percentile=0.9, hedge_default_delay=0.75, fanout_k=2, root_zone=None, ns_cache=None,
+                 ns_parallel=4, ns_timeout=NS_TIMEOUT, rrset_order="cyclic", prefetch_fraction=0.1, prefetch_min_hits=3, prefetch_rate=10,
+                 stale_window=STALE_WINDOW, stale_answer_timeout=1.8, background_workers=32, cache_policy="lru"):
+        self.root_servers = list(root_servers or ROOT_SERVERS)
+        # (qname, qtype, qclass) -> rrset, expires with the upstream ttl, a cache passed in needs its own stale_ttl and policy
+        self.cache = cache if cache is not None else RRsetCache(cache_limit, stale_ttl=stale_window, policy=cache_policy)
+        self.neg_cache = neg_cache if neg_cache is not None else TTLCache(cache_limit) # (qname, qtype) -> (NXDOMAIN or NODATA, soa rr)
+        self.infra = infra or InfraCache() # per server ip srtt / rto / backoff
+        self.delegations = delegations or DelegationCache() # ns referrals + glue by zone, so misses can skip the root (and tld) hops
+        self.upstream = upstream or UpstreamPool() # opened on first use in each process
+        self.query_log = query_log # anything with write(records), None keeps the records only in the return value
+        self.tracer = tracer # tracing.Tracer for per hop spans, optional
+        self.step_time = step_time # {step: metrics.Histogram} of step wall times, optional
+        self.hedge_mode = hedge_mode # "hedge" adds a parallel query when a server is slow, "fanout" asks fanout_k at once, "off" one at a time
+        self.hedge_percentile = hedge_percentile
+        self.hedge_default_delay = hedge_default_delay # used until a step has enough rtt samples for the percentile
+        self.fanout_k = fanout_k
+        self.root_zone = root_zone # root_zone.RootZone, answers the root step locally while its copy is fresh
+        self.ns_addrs = ns_cache if ns_cache is not None else TTLCache(cache_limit) # ns name -> [ip], for glueless referrals
+        self.ns_parallel = ns_parallel # ns names of one glueless referral looked up at once
+        self.ns_timeout = ns_timeout
+        self.order = RRsetOrder(rrset_order, cache_limit * 4) # "cyclic", "random" or "fixed" order for multi-record answers
+        # hot rrsets are refreshed in the background once they're in the last prefetch_fraction of their ttl,
+        # if they were read at least prefetch_min_hits times, starting at most prefetch_rate of these walks a second
+        self.prefetch_policy = (prefetch_fraction, prefetch_min_hits) if prefetch_fraction else None
+        self.prefetch_bucket = TokenBucket(prefetch_rate)
+        # rfc 8767: a miss with an expired copy still inside stale_window gets that copy if the walk fails or
+        # takes longer than stale_answer_timeout, the walk keeps going in the background and refreshes the cache
+        self.stale_window = stale_window
+        self.stale_answer_timeout = stale_answer_timeout
+        self.background_workers = background_workers
+        self.pool, self.pool_pid = None, None # background thread pool, made on first use in each process
+        self.inflight = SingleFlight() # misses currently being walked, keyed by (qname, qtype)
+        self.step_latency = {step: LatencyWindow() for step in STEPS} # recent rtts per step, for the hedging delay
+        self.counters = {"upstream_truncated": 0, "upstream_tcp_failed": 0, # truncation events
+                         "prefetch_started": 0, "prefetch_rate_limited": 0, "prefetch_failed": 0, "stale_served": 0}
+        self.counter_lock = threading.Lock()
+
+    def count(self, name):
+        with self.counter_lock:
+            self.counters[name] += 1
+
+    def span(self, name, start_ns, qname=None):
+        if self.tracer is not None:
+            self.tracer.add(name, start_ns, qname)
+
+    def log(self, records):
+        if self.query_log is not None and records:
+            span_start = time.perf_counter_ns()
+            self.query_log.write(records) # only queued, the writer thread does the disk io
+            self.span("log", span_start, records[0].domain)
+
+    def background(self):
+        # thread pool for prefetches and for walks raced against the stale answer timer, made again after a fork
+        if self.pool_pid != os.getpid():
+            with self.counter_lock:
+                if self.pool_pid != os.getpid():
+                    self.pool = ThreadPoolExecutor(max_workers=self.background_workers)
+                    self.pool_pid = os.getpid()
+        return self.pool
+
+    def resolve(self, name, qtype="A"):
+        # (answer RRs, remaining ttl, negative, log records), negative is (NXDOMAIN or NODATA, soa rr) or None
+        # the answer is empty on failure and for negative answers, otherwise any cname chain followed by the final rrset
+        name = name.lower().rstrip('.')
+        result = self.lookup(name, qtype, log=False)
+        if result is None:
+            answer, ttl, negative, logs = self.walk_or_stale(name, qtype)
+            result = self.order.apply((name, qtype), answer), ttl, negative, logs
+        self.log(result[3])
+        return result
+
+    def walk_or_stale(self, name, qtype):
+        # walk for a miss, but with an expired copy around the client gets that instead of waiting on a failing or slow walk
+        total_start = time.perf_counter()
+        stale = self.cached_answer(name, qtype, stale=True) if self.stale_window else None
+        if stale is None:
+            return self.walk(name, qtype)
+        future = self.background().submit(self.walk, name, qtype)
+        try:
+            answer, ttl, negative, logs = future.result(timeout=self.stale_answer_timeout)
+            if answer or negative:
+                return answer, ttl, negative, logs
+        except TimeoutError: # the walk's records get logged whenever it finishes
+            future.add_done_callback(lambda f: f.exception() is None and self.log(f.result()[3]))
+            logs = []
+        self.count("stale_served")
+        answer, ttl = stale
+        return answer, ttl, None, [LogRecord(now_stamp(), name, "Cache", "-", "Cache", describe(answer), 0,
+                                             round(time.perf_counter() - total_start, 4), "STALE")] + logs
+
+    def prefetch(self, name, qtype="A"):
+        # refreshes name's rrset of qtype with a background walk, False if the prefetch rate limit said no
+        if not self.prefetch_bucket.take():
+            self.count("prefetch_rate_limited")
+            return False
+        self.count("prefetch_started")
+        self.background().submit(self.run_prefetch, name, qtype)
+        return True
+
+    def run_prefetch(self, name, qtype):
+        try:
+            answer, ttl, negative, logs = self.walk(name, qtype, refresh=True)
+        except Exception as e:
+            print(f"prefetch of {name} {qtype} failed: {e}")
+            self.count("prefetch_failed")
+            return
+        if not answer and not negative:
+            self.count("prefetch_failed")
+        for entry in logs:
+            entry.resolution_mode = "Prefetch"
+        self.log(logs)
+
+    def resolve_many(self, names, qtype="A", concurrency=32):
+        # resolves names (or (name, qtype) pairs) concurrently, yields (name, result) as each one finishes
+        # at most `concurrency` walks run at once, the iterable is only read as slots free up
+        names = iter(names)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            pending = {}
+            def submit_next():
+                item = next(names, None)
+                if item is None:
+                    return False
+                name, qt = (item, qtype) if isinstance(item, str) else item
+                pending[pool.submit(self.resolve, name, qt)] = name
+                return True
+            while len(pending) < concurrency and submit_next():
+                pass
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+                    submit_next()
+
+    def lookup(self, name, qtype="A", log=True):
+        # (answer RRs, remaining ttl, negative, logs) straight from the caches, None on a miss
+        total_start = time.perf_counter()
+        span_start = time.perf_counter_ns()
+        result = None
+        cached = self.cached_answer(name, qtype) # (RRs, ttl left) if found else None
+        if cached:
+            answer, ttl = cached
+            result = self.order.apply((name, qtype), answer), ttl, None, [LogRecord(now_stamp(), name, "Cache", "-", "Cache", describe(answer), 0,
+                                                                                     round(time.perf_counter() - total_start, 4), "HIT")]
+        else:
+            negative = self.neg_cache.get_entry((name, qtype)) # we already know this name doesn't exist
+            if negative:
+                negative, ttl = negative
+                result = [], ttl, negative, [LogRecord(now_stamp(), name, "Cache", "-", "Cache", negative[0], 0,
+                                                       round(time.perf_counter() - total_start, 4), "NEGATIVE_HIT")]
+        self.span("cache_lookup", span_start, name)
+        if result is not None and log:
+            self.log(result[3])
+        return result
+
+    def cached_answer(self, name, qtype, stale=False):
+        # (RRs, ttl left) for name's rrset of qtype, following cached cname links, None if any link or the rrset is missing
+        # stale=True also takes expired rrsets inside the stale window, otherwise rrsets that are due get prefetched
+        rtype = getattr(QTYPE, qtype)
+        answer, ttl, seen = [], MAX_TTL, {name}
+        while True:
+            cached = self.cached_rrset(name, rtype, stale)
+            if cached:
+                return answer + cached[0], min(ttl, cached[1])
+            link = self.cached_rrset(name, QTYPE.CNAME, stale) if rtype != QTYPE.CNAME else None
+            if not link:
+                return None
+            answer += link[0]
+            ttl = min(ttl, link[1])
+            name = str(link[0][0].rdata).rstrip('.').lower()
+            if name in seen or len(seen) > MAX_CNAME_CHAIN:
+                return None
+            seen.add(name)
+
+    def cached_rrset(self, name, rtype, stale=False):
+        if stale:
+            return self.cache.get_stale_rrset(name, rtype)
+        if self.prefetch_policy is None:
+            return self.cache.get_rrset(name, rtype)
+        cached = self.cache.get_rrset(name, rtype, prefetch=self.prefetch_policy)
+        if cached is None:
+            return None
+        if cached[2]: # hot and about to expire, this caller won the claim
+            self.prefetch(name, QTYPE[rtype])
+        return cached[:2]
+
+    def walk(self, name, qtype="A", chain=(), refresh=False):
+        # cache miss: one upstream walk per name, anyone asking for the same name meanwhile waits for it
+        # chain holds the names whose glueless referrals or cnames led to this walk, innermost last
+        # a chained walk never waits on one already running, that one could be waiting on us (a.x.com -> b.y.com -> a.x.com)
+        # refresh=True (prefetch) asks upstream for every link of a cname chain even if it's still cached
+        wait_start = time.perf_counter()
+        span_start = time.perf_counter_ns()
+        (answer, ttl, negative, log_entries), shared = self.inflight.do((name, qtype), self.resolve_miss, name, qtype, chain,
+                                                                         refresh, join=not chain)
+        self.span("coalesced_wait" if shared else "walk", span_start, name)
+        if shared: # someone else was already walking this name, we just waited for their answer
+            response = describe(answer) or (negative[0] if negative else "N/A")
+            return answer, ttl, negative, [LogRecord(now_stamp(), name, "Recursive", "-", "Coalesced",
+                                                     response, 0, round(time.perf_counter() - wait_start, 4), "COALESCED")]
+        return answer, ttl, negative, log_entries
+
+    def resolve_miss(self, domain, qtype="A", chain=(), refresh=False): # the actual root -> tld -> authoritative walk
+        log_entries = [] # list of LogRecords
+        total_start = time.perf_counter()
+        link = self.cache.get_rrset(domain, QTYPE.CNAME) if qtype != "CNAME" and not refresh else None
+        if link: # alias we already know, only its target needs resolving
+            target = str(link[0][0].rdata).rstrip('.').lower()
+            log_entries.append(LogRecord(now_stamp(), domain, "Cache", "-", "Cache", "CNAME " + target, 0, 0, "HIT"))
+            return self.follow_cname(domain, qtype, target, link[0], link[1], log_entries, total_start, chain)
+        cut = self.delegations.find(domain) # deepest zone we already have servers for
+        if cut:
+            zone_cut, current_servers = cut
+            first_step = 1 if "." not in zone_cut else 2 # tld servers if the cut is like "com", else straight to the authoritative ones
+            server_zone = zone_cut
+        else:
+            zone_cut, current_servers = ".", self.root_servers.copy() # nothing cached, start looking from root servers
+            first_step = 0
+            server_zone = "." # zone the servers we're asking are authoritative for, their answers are only trusted inside it
+            local = self.root_zone.referral(domain) if self.root_zone is not None else None
+            if local is not None and local[0] == "NXDOMAIN": # tld doesn't exist, the root zone copy is proof enough
+                _, soa, ttl = local
+                log_entries.append(LogRecord(now_stamp(), domain, "Recursive", "local-root", "Root", "NXDOMAIN", 0, 0, "MISS", zone_cut))
+                self.finish_logs(log_entries, total_start)
+                self.neg_cache.put((domain, qtype), ("NXDOMAIN", soa), ttl)
+                return [], ttl, ("NXDOMAIN", soa), log_entries
+            if local is not None: # same referral a root server would have sent, without the round trip
+                _, tld, ns_names, current_servers, ttl = local
+                self.delegations.put(tld, ns_names, current_servers, ttl)
+                server_zone = tld
+                log_entries.append(LogRecord(now_stamp(), domain, "Recursive", "local-root", "Root", ",".join(current_servers), 0, 0, "MISS", zone_cut))
+                first_step = 1
+        visited = 0 # servers asked in this walk, for logs that report it
+        for step_name in STEPS[first_step:]:
+            hop_start = step_start = time.perf_counter_ns()
+            for server, resp, rtt in self.ask_servers(domain, qtype, self.infra.order(current_servers), step_name): # fastest first
+                visited += 1
+                self.span(step_name, hop_start, domain) # waiting on this server (and any tcp / no-edns retry)
+                hop_start = time.perf_counter_ns()
+                timestamp = now_stamp()
+                if resp is None:
+                    continue  # try next server
+                if resp.header.rcode in LAME_RCODES:
+                    self.infra.record_failure(server, timed_out=False) # lame, back it off and try the next one
+                    continue
+                answer = resp.rr # found response, will get either next step servers or resolved ip
+                if answer: # the rrset, or a cname chain we have to follow
+                    self.step_done(step_name, step_start, hop_start)
+                    records, ttl, target = self.read_answer(domain, qtype, answer, server_zone)
+                    response = "CNAME " + target if target else (describe(records) or "N/A")
+                    log_entries.append(LogRecord(timestamp, domain, "Recursive", server, step_name, response, round(rtt, 4), 0, "MISS", zone_cut,
+                                                  visited)) # total_time filled in below
+                    if target:
+                        return self.follow_cname(domain, qtype, target, records, ttl, log_entries, total_start, chain, refresh)
+                    self.finish_logs(log_entries, total_start)
+                    return records, ttl, None, log_entries
+                negative = negative_answer(resp)
+                if negative: # nxdomain or nodata, asking the other servers won't change that
+                    self.step_done(step_name, step_start, hop_start)
+                    rcode, soa, ttl = negative
+                    log_entries.append(LogRecord(timestamp, domain, "Recursive", server, step_name, rcode, round(rtt, 4), 0, "MISS", zone_cut, visited))
+                    self.finish_logs(log_entries, total_start)
+                    self.neg_cache.put((domain, qtype), (rcode, soa), ttl)
+                    return [], ttl, (rcode, soa), log_entries
+                referral = parse_referral(resp, server_zone)
+                if referral and (referral[0] == server_zone or not in_bailiwick(referral[0], server_zone) or not in_bailiwick(domain, referral[0])):
+                    referral = None # has to be a cut below the zone this server is authoritative for, on the way to domain
+                if not referral:
+                    self.infra.record_failure(server, timed_out=False) # neither an answer nor a usable referral, treat it as lame
+                    continue
+                self.step_done(step_name, step_start, hop_start)
+                zone, ns_names, new_servers, ns_ttl = referral # next step servers from the glue
+                if not new_servers: # glueless, look the ns names up ourselves
+                    new_servers, addr_ttl = self.ns_addresses(zone, ns_names, chain + (domain,))
+                    referral = zone, ns_names, new_servers, min(ns_ttl, addr_ttl)
+                if new_servers:
+                    current_servers = new_servers
+                    self.delegations.put(*referral) # zone, ns names, glue, ttl
+                    server_zone = zone
+                    log_entries.append(LogRecord(timestamp, domain, "Recursive", server, step_name, ",".join(new_servers), round(rtt, 4), 0, "MISS", zone_cut,
+                                                  visited))
+                    break
+            else:
+                continue # no server in this step helped, move on to the next one
+        self.finish_logs(log_entries, total_start)
+        return [], 0, None, log_entries
+
+    def step_done(self, step_name, step_start, reply_at):
+        # wall time of a step, from its first query to the reply we went on with (timeouts, lame servers and hedges included)
+        if self.step_time is not None:
+            self.step_time[step_name].record((reply_at - step_start) / 1e9)
+
+    def read_answer(self, domain, qtype, answer, zone):
+        # (RRs, ttl, cname target) from an answer section, caching each cname link and the final rrset separately
+        # target is set when the chain leaves what this server may speak for, or ends without the rrset we asked for
+        rtype = getattr(QTYPE, qtype)
+        rrsets = {}
+        for rr in answer:
+            owner = str(rr.rname).rstrip('.').lower()
+            if in_bailiwick(owner, zone): # out of zone data is dropped, the target's own servers get asked instead
+                rrsets.setdefault((owner, rr.rtype), []).append(rr)
+        records, name, ttl, seen = [], domain, MAX_TTL, {domain}
+        while (name, rtype) not in rrsets and (name, QTYPE.CNAME) in rrsets:
+            link = rrsets[(name, QTYPE.CNAME)][:1]
+            target = str(link[0].rdata).rstrip('.').lower()
+            if target in seen:
+                return [], 0, None # loop inside one answer
+            self.cache.put_rrset(name, QTYPE.CNAME, link)
+            records += link
+            ttl = min(ttl, link[0].ttl)
+            seen.add(target)
+            name = target
+        rrset = rrsets.get((name, rtype))
+        if rrset:
+            self.cache.put_rrset(name, rtype, rrset)
+            return records + rrset, min([ttl] + [rr.ttl for rr in rrset]), None
+        return records, ttl, (name if name != domain else None)
+
+    def follow_cname(self, domain, qtype, target, records, ttl, log_entries, total_start, chain, refresh=False):
+        # resolves a cname target as a name of its own, so every alias of a shared target reuses its cache entry
+        # records are the cname links that led to target, they go in front of whatever target resolves to
+        chain = chain + (domain,)
+        if target in chain or len(chain) > MAX_CNAME_CHAIN:
+            self.finish_logs(log_entries, total_start)
+            return [], 0, None, log_entries # loop across zones or an absurd chain, fails like an unanswered walk
+        cached = None if refresh else self.lookup(target, qtype, log=False)
+        answer, target_ttl, negative, target_logs = cached or self.walk(target, qtype, chain, refresh)
+        log_entries += target_logs
+        self.finish_logs(log_entries, total_start)
+        return (records + answer if answer else []), min(ttl, target_ttl), negative, log_entries
+
+    def ns_addresses(self, zone, ns_names, chain):
+        # (ips, ttl) for the ns names of a glueless referral, from ns_addrs or else resolved in parallel as walks of their own
+        # returns once one name has an address, the lookups still running finish in the background and fill ns_addrs
+        ips, ttl, missing = [], MAX_TTL, []
+        for name in ns_names:
+            cached = self.ns_addrs.get_entry(name)
+            if cached:
+                ips += cached[0]
+                ttl = min(ttl, cached[1])
+            elif name not in chain and name != zone and not name.endswith("." + zone): # in-zone names needed glue
+                missing.append(name)
+        if ips or not missing or len(chain) >= MAX_NS_DEPTH:
+            return ips, ttl
+        span_start = time.perf_counter_ns()
+        pool = ThreadPoolExecutor(max_workers=min(len(missing), self.ns_parallel))
+        try:
+            for future in as_completed([pool.submit(self.resolve_ns, name, chain) for name in missing], timeout=self.ns_timeout):
+                found, found_ttl = future.result()
+                if found:
+                    return found, min(ttl, found_ttl)
+            return [], 0
+        except TimeoutError: # none resolved in time, the referral is useless to this walk
+            return [], 0
+        finally:
+            pool.shutdown(wait=False)
+            self.span("ns_lookup", span_start, chain[-1])
+
+    def resolve_ns(self, name, chain):
+        # sub-resolution of one ns name, through the same caches as client queries
+        answer, ttl, _, logs = self.lookup(name, "A", log=False) or self.walk(name, "A", chain)
+        self.log(logs)
+        ips = [str(rr.rdata) for rr in answer if rr.rtype == QTYPE.A]
+        if ips:
+            self.ns_addrs.put(name, ips, ttl)
+        return ips, ttl
+
+    def finish_logs(self, log_entries, total_start):
+        total_time = round(time.perf_counter() - total_start, 4)
+        for entry in log_entries:
+            entry.total_time = total_time
+
+    def ask_servers(self, domain, qtype, servers, step_name):
+        # yields (server, response, rtt) as replies arrive, response is None when a server times out
+        # keeps fanout_k queries outstanding (1 unless hedge_mode is "fanout"), and in "hedge" mode sends to the next
+        # server too when the current one is slower than the step's hedge_percentile latency
+        upstream, infra = self.upstream, self.infra
+        target = self.fanout_k if self.hedge_mode == "fanout" else 1
+        results = queue.Queue()
+        pending = {} # upstream key -> (server, deadline)
+        servers = list(servers)
+        last_launch = 0
+        try:
+            while servers or pending:
+                now = time.perf_counter()
+                while servers and len(pending) < target:
+                    server = servers.pop(0)
+                    try:
+                        key = upstream.send(domain, server, results, qtype=qtype)
+                    except OSError: # unreachable, counts like a timeout
+                        infra.record_failure(server)
+                        yield server, None, None
+                        continue
+                    pending[key] = (server, now + infra.timeout(server)) # wait as long as this server's rto, 3 s at most
+                    last_launch = now
+                if not pending:
+                    continue
+                wake = min(deadline for _, deadline in pending.values())
+                hedge_delay = None
+                if self.hedge_mode == "hedge":
+                    hedge_delay = self.step_latency[step_name].percentile(self.hedge_percentile) or self.hedge_default_delay
+                if hedge_delay is not None and servers:
+                    wake = min(wake, last_launch + hedge_delay)
+                try:
+                    key, resp, rtt = results.get(timeout=max(wake - time.perf_counter(), 0))
+                except queue.Empty:
+                    now = time.perf_counter()
+                    for key, (server, deadline) in list(pending.items()):
+                        if deadline <= now:
+                            del pending[key]
+                            upstream.cancel(key)
+                            infra.record_failure(server)
+                            yield server, None, None
+                    if hedge_delay is not None and servers and now >= last_launch + hedge_delay:
+                        target = len(pending) + 1 # slow reply, hedge with the next candidate
+                    continue
+                if key not in pending:
+                    continue # already gave up on it
+                server, _ = pending.pop(key)
+                upstream.cancel(key)
+                if resp.header.rcode not in LAME_RCODES: # a lame reply is a failure, recording its rtt would undo the backoff
+                    infra.record_rtt(server, rtt)
+                self.step_latency[step_name].add(rtt)
+                resp, rtt = self.retry_if_needed(domain, qtype, server, resp, rtt)
+                yield server, resp, rtt
+        finally: # caller got its answer (or gave up), stop listening for the rest
+            for key in pending:
+                upstream.cancel(key)
+
+    def retry_if_needed(self, domain, qtype, server, resp, rtt):
+        # truncated udp reply -> ask the same server over tcp, FORMERR (server choked on our OPT) -> ask again without edns
+        if resp.header.tc:
+            self.count("upstream_truncated")
+            tcp_resp, tcp_rtt = tcp_query(domain, server, timeout=self.infra.timeout(server), qtype=qtype)
+            if tcp_resp is None:
+                self.count("upstream_tcp_failed")
+                return resp, rtt # partial answer is still better than nothing
+            return tcp_resp, rtt + tcp_rtt
+        if resp.header.rcode == RCODE.FORMERR and self.upstream.edns_size:
+            plain, plain_rtt = self.upstream.query(domain, server, timeout=self.infra.timeout(server), qtype=qtype, edns=False)
+            if plain is not None:
+                return plain, rtt + plain_rtt
+        return resp, rtt
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+from dnslib import RR, QTYPE, SOA
+from dns_cache import MAX_NEGATIVE_TTL
+from delegation import labels
+
+MIN_TLDS = 1000 # the real root zone delegates about 1450 tlds
+# local copy of the root zone (rfc 8806), so a cold miss gets its tld referral without asking a root server
+# the zone file is parsed into a small index (tld -> ns names, glue, ttl) on a background thread and swapped in whole,
+# queries only ever read the current index
+# once the file is older than the zone's SOA expire field the copy is treated as stale and the resolver goes back
+# to the live roots until a fresh file shows up
+# unknown tlds only get a local NXDOMAIN when the copy looks complete (at least min_tlds delegations), a trimmed
+# or truncated file still gives referrals for what it has but leaves everything else to the live roots
+#
+# expects the zone in the one-record-per-line format of https://www.internic.net/domain/root.zone
+
+class RootZoneIndex:
+    __slots__ = ("serial", "soa", "expire", "tlds")
+
+    def __init__(self, serial, soa, expire, tlds):
+        self.serial = serial
+        self.soa = soa # dnslib RR, goes in the authority section of NXDOMAIN replies
+        self.expire = expire # seconds the copy stays usable after it was written
+        self.tlds = tlds # tld -> (ns names, glue ips, ttl)
+
+def parse_zone(path):
+    ns, glue, soa = {}, {}, None
+    origin, default_ttl = ".", 86400
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split(";", 1)[0].strip()
+            if not line:
+                continue
+            fields = line.split()
+            if fields[0] == "$ORIGIN":
+                origin = fields[1]
+                continue
+            if fields[0] == "$TTL":
+                default_ttl = int(fields[1])
+                continue
+            name = fields[0]
+            if name == "@":
+                name = origin
+            elif not name.endswith("."):
+                name = name + "." + origin.lstrip(".") if origin != "." else name + "."
+            rest = fields[1:]
+            ttl = default_ttl
+            if rest and rest[0].isdigit():
+                ttl, rest = int(rest[0]), rest[1:]
+            if rest and rest[0].upper() == "IN":
+                rest = rest[1:]
+            if len(rest) < 2:
+                continue
+            rtype, rdata = rest[0].upper(), rest[1:]
+            owner = name.rstrip(".").lower()
+            if rtype == "NS" and owner:
+                names, lowest = ns.get(owner, ([], ttl))
+                names.append(rdata[0].rstrip(".").lower())
+                ns[owner] = (names, min(lowest, ttl))
+            elif rtype == "A":
+                glue.setdefault(owner, []).append(rdata[0])
+            elif rtype == "SOA" and not owner:
+                times = [int(x) for x in rdata[2:7]]
+                soa = RR(".", QTYPE.SOA, ttl=ttl, rdata=SOA(rdata[0], rdata[1], times))
+    if soa is None:
+        raise ValueError(f"{path}: no root SOA record")
+    tlds = {}
+    for tld, (names, ttl) in ns.items():
+        tlds[tld] = (names, [ip for n in names for ip in glue.get(n, [])], ttl)
+    return RootZoneIndex(soa.rdata.times[0], soa, soa.rdata.times[3], tlds)
+
+class RootZone:
+    def __init__(self, path, reload_interval=3600, max_age=None, min_tlds=MIN_TLDS):
+        self.path = path
+        self.min_tlds = min_tlds
+        self.reload_interval = reload_interval # seconds between checks for a newer file
+        self.max_age = max_age # overrides the SOA expire field when set
+        self.index = None
+        self.mtime = None # of the file the current index came from
+        self.pid = None # reload thread is started lazily, and again in each forked worker
+        self.lock = threading.Lock()
+
+    def load(self):
+        # parses the file if it changed since the last load, True if a new index was swapped in
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.mtime:
+                return False
+            index = parse_zone(self.path)
+        except (OSError, ValueError, IndexError) as e:
+            print(f"root zone not loaded from {self.path}: {e}")
+            return False
+        self.index, self.mtime = index, mtime # readers see either the old index or the new one, never half of it
+        partial = "" if len(index.tlds) >= self.min_tlds else ", too few to be complete, unknown tlds go to the root servers"
+        print(f"root zone serial {index.serial} loaded, {len(index.tlds)} tlds{partial}")
+        return True
+
+    def start(self):
+        self.load()
+        return self
+
+    def ensure_reloading(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                threading.Thread(target=self.reload_loop, daemon=True).start()
+                self.pid = os.getpid()
+
+    def reload_loop(self):
+        while True:
+            time.sleep(self.reload_interval)
+            self.load()
+
+    def fresh(self):
+        index = self.index
+        if index is None:
+            return None
+        max_age = self.max_age if self.max_age is not None else index.expire
+        return index if time.time() - self.mtime < max_age else None
+
+    def referral(self, qname):
+        # ("referral", tld, ns names, glue ips, ttl) or ("NXDOMAIN", soa rr, ttl) for qname
+        # None if the copy is stale, or doesn't know the tld and is too small to be sure it doesn't exist
+        self.ensure_reloading()
+        index = self.fresh()
+        parts = labels(qname)
+        if index is None or not parts:
+            return None
+        tld = parts[0]
+        found = index.tlds.get(tld)
+        if found is None:
+            if len(index.tlds) < self.min_tlds:
+                return None
+            soa = index.soa
+            return "NXDOMAIN", soa, min(soa.ttl, soa.rdata.times[4], MAX_NEGATIVE_TTL)
+        ns_names, servers, ttl = found
+        if not servers:
+            return None # no glue in the file, let a real root server sort it out
+        return "referral", tld, ns_names, servers, ttl
@@ -0,0 +1,48 @@
+import threading
+# single-flight: concurrent calls with the same key share one execution
+# the first caller (the leader) does the work, everyone who shows up while it runs waits for its result
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # key -> Call currently running
+
+    def do(self, key, fn, *args, join=True):
+        # returns (result, shared), shared is True when this caller waited on someone else's call
+        # with join=False a call already running isn't waited on, fn runs again for this caller (for callers that
+        # might be what the running call is itself waiting on, they'd deadlock)
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            elif join:
+                call.waiters += 1
+        if not leader and not join: # outside the lock, fn can do a whole walk and call do() again itself
+            return fn(*args), False
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key] # later callers start a fresh call (or hit the cache the leader filled)
+            call.done.set()
+        return call.result, False
+
+    def inflight(self):
+        with self.lock:
+            return len(self.calls)
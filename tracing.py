@@ -0,0 +1,84 @@
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter, deque
+# per query spans and an on-demand sampling profiler
+# spans are (name, start, end) in perf_counter_ns, appended to a bounded ring so tracing can stay on all the time;
+# dumping them gives a chrome trace (load it in chrome://tracing or ui.perfetto.dev)
+# the profiler samples every thread's stack for a few seconds and writes collapsed stacks, the input flamegraph.pl
+# and speedscope take
+
+class Tracer:
+    def __init__(self, capacity=100000, enabled=True):
+        self.enabled = enabled
+        self.spans = deque(maxlen=capacity) # oldest spans fall off, append is thread safe
+
+    def add(self, name, start_ns, qname=None):
+        # one finished span, start_ns from time.perf_counter_ns(), ends now
+        if self.enabled:
+            self.spans.append((name, start_ns, time.perf_counter_ns(), threading.get_native_id(), qname))
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        events = []
+        for name, start, end, tid, qname in list(self.spans):
+            event = {"name": name, "ph": "X", "ts": start / 1000, "dur": (end - start) / 1000, "pid": pid, "tid": tid}
+            if qname is not None:
+                event["args"] = {"qname": qname}
+            events.append(event)
+        for t in threading.enumerate(): # thread names instead of bare ids in the viewer
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": t.native_id, "args": {"name": t.name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        return path
+
+def sample_stacks(seconds, interval=0.005):
+    # wall clock sampling of every other thread, returns Counter of "thread;outer;...;inner" -> samples
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    counts = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(tid, str(tid)))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+def collapsed(counts):
+    return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+def dump_profile(path, seconds, interval=0.005):
+    with open(path, 'w') as f:
+        f.write(collapsed(sample_stacks(seconds, interval)))
+    return path
+
+def install_signal_handlers(tracer, directory, profile_seconds):
+    # SIGUSR1 writes the span ring as a chrome trace, SIGUSR2 profiles for profile_seconds, both into directory
+    def stamp(kind, ext):
+        return os.path.join(directory, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{ext}")
+
+    def on_trace(signum, frame):
+        print(f"trace written to {tracer.dump(stamp('trace', 'json'))}")
+
+    def on_profile(signum, frame): # the sampling runs on its own thread, the handler returns right away
+        def run():
+            print(f"profile written to {dump_profile(stamp('profile', 'folded'), profile_seconds)}")
+        threading.Thread(target=run, name="profiler", daemon=True).start()
+
+    os.makedirs(directory, exist_ok=True)
+    signal.signal(signal.SIGUSR1, on_trace)
+    signal.signal(signal.SIGUSR2, on_profile)
@@ -0,0 +1,147 @@
+import os
+import socket
+import struct
+import random
+import selectors
+import threading
+import time
+from dnslib import DNSRecord, EDNS0
+# long lived pool of upstream udp sockets shared by every hop query
+# replies are matched back to the waiting query by (server, port, txid, qname), so one socket carries many queries at once
+
+class Pending: # one outstanding hop query
+    __slots__ = ("done", "start", "response", "rtt", "results")
+
+    def __init__(self, results=None):
+        self.done = threading.Event()
+        self.start = time.time()
+        self.response = None
+        self.rtt = None
+        self.results = results # optional queue that also gets (key, response, rtt), lets one thread wait on several queries
+
+class UpstreamPool:
+    def __init__(self, size=4, edns_size=1232):
+        self.size = size
+        self.edns_size = edns_size # udp payload size we advertise upstream, 0 turns edns off
+        self.recv_size = max(edns_size, 512)
+        self.lock = threading.Lock()
+        self.pending = {} # (server, port, txid, qname) -> Pending
+        self.socks = []
+        self.pid = None # sockets and the receiver thread are opened lazily, and again after a fork
+
+    def open_socket(self):
+        # random source port so replies are harder to spoof, kernel picks one if we keep colliding
+        for _ in range(20):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.bind(("0.0.0.0", random.randint(1024, 65535)))
+                return s
+            except OSError:
+                s.close()
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("0.0.0.0", 0))
+        return s
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pending = {}
+            self.socks = [self.open_socket() for _ in range(self.size)]
+            threading.Thread(target=self.recv_loop, args=(self.socks,), daemon=True).start()
+            self.pid = os.getpid()
+
+    def recv_loop(self, socks):
+        sel = selectors.DefaultSelector()
+        for s in socks:
+            sel.register(s, selectors.EVENT_READ)
+        while True:
+            for sel_key, _ in sel.select():
+                try:
+                    data, addr = sel_key.fileobj.recvfrom(self.recv_size)
+                    resp = DNSRecord.parse(data)
+                except Exception:
+                    continue # junk or truncated packet, whoever was waiting will time out
+                qname = str(resp.q.qname).rstrip('.').lower()
+                with self.lock:
+                    key = (addr[0], addr[1], resp.header.id, qname)
+                    p = self.pending.get(key)
+                if p is None or p.done.is_set():
+                    continue # late, duplicate or unsolicited reply
+                p.rtt = time.time() - p.start
+                p.response = resp
+                p.done.set()
+                if p.results is not None:
+                    p.results.put((key, resp, p.rtt))
+
+    def register(self, qname, server_ip, port, results=None):
+        # picks a txid that isn't already outstanding for this server and name
+        with self.lock:
+            while True:
+                key = (server_ip, port, random.randint(0, 65535), qname.lower())
+                if key not in self.pending:
+                    p = self.pending[key] = Pending(results)
+                    return key, p
+
+    def make_query(self, qname, qtype, edns):
+        q = DNSRecord.question(qname, qtype)
+        if edns and self.edns_size:
+            q.add_ar(EDNS0(udp_len=self.edns_size)) # bigger referrals fit without truncation or lost glue
+        return q
+
+    def send(self, qname, server_ip, results, port=53, qtype="A", edns=True):
+        # fire and forget, the reply shows up on results as (key, response, rtt), call cancel(key) when done with it
+        self.ensure_started()
+        q = self.make_query(qname, qtype, edns)
+        key, p = self.register(qname, server_ip, port, results)
+        q.header.id = key[2]
+        p.start = time.time()
+        random.choice(self.socks).sendto(q.pack(), (server_ip, port))
+        return key
+
+    def cancel(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+
+    def query(self, qname, server_ip, port=53, timeout=3, qtype="A", edns=True):
+        # same contract as the old query_server: (parsed response, rtt) or (None, None) on timeout
+        self.ensure_started()
+        q = self.make_query(qname, qtype, edns)
+        key, p = self.register(qname, server_ip, port)
+        q.header.id = key[2]
+        try:
+            p.start = time.time()
+            random.choice(self.socks).sendto(q.pack(), (server_ip, port))
+            if not p.done.wait(timeout):
+                return None, None
+            return p.response, p.rtt
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+def recv_exact(s, n):
+    buf = b""
+    while len(buf) < n:
+        chunk = s.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed mid message")
+        buf += chunk
+    return buf
+
+def tcp_query(qname, server_ip, port=53, timeout=3, qtype="A"):
+    # one query over tcp (2 byte length prefix, rfc 1035 4.2.2), used when a udp reply comes back truncated
+    q = DNSRecord.question(qname, qtype)
+    packet = q.pack()
+    start = time.time()
+    try:
+        with socket.create_connection((server_ip, port), timeout=timeout) as s:
+            s.sendall(struct.pack("!H", len(packet)) + packet)
+            length = struct.unpack("!H", recv_exact(s, 2))[0]
+            resp = DNSRecord.parse(recv_exact(s, length))
+    except Exception:
+        return None, None
+    if resp.header.id != q.header.id:
+        return None, None
+    return resp, time.time() - start
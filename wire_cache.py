@@ -0,0 +1,115 @@
+import struct
+import threading
+import time
+from collections import OrderedDict
+from dns_cache import MIN_PREFETCH_WINDOW
+# cache of fully packed responses keyed by the raw question bytes of the query
+# the question's end offset comes from query_parser, so nothing gets parsed twice
+# a hit copies the stored packet, patches in the client's txid / rd bit / qname case and the remaining ttls, and that's it
+# no DNSRecord.parse, no RR objects, no pack() on the hot path
+
+OPT = 41 # edns pseudo record, its "ttl" field is flags so it's never touched
+
+def cache_key(data, pq):
+    # question bytes with the qname lowercased (qtype / qclass bytes left alone, lowering those would mix up types)
+    # plus whether the client used edns, since that decides if the stored reply carries an OPT record
+    q_end = pq.q_end
+    return bytes(data[12:q_end - 4]).lower() + bytes(data[q_end - 4:q_end]) + (b"E" if pq.edns_size else b"-")
+
+def skip_name(packet, pos):
+    while True:
+        n = packet[pos]
+        if n & 0xC0 == 0xC0: # compression pointer ends the name
+            return pos + 2
+        if n == 0:
+            return pos + 1
+        pos += n + 1
+
+def ttl_offsets(packet):
+    # [(offset of the ttl field, ttl)] for every rr in the answer, authority and additional sections
+    qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHH", packet, 4)
+    pos = 12
+    for _ in range(qdcount):
+        pos = skip_name(packet, pos) + 4
+    offsets = []
+    for _ in range(ancount + nscount + arcount):
+        pos = skip_name(packet, pos)
+        rtype, _, ttl, rdlen = struct.unpack_from("!HHIH", packet, pos)
+        if rtype != OPT:
+            offsets.append((pos + 4, ttl))
+        pos += 10 + rdlen
+    return offsets
+
+class WireEntry:
+    __slots__ = ("packet", "offsets", "stored", "expires", "qname", "response", "status", "hits", "prefetched")
+
+    def __init__(self, packet, offsets, qname, response, status):
+        self.packet = packet
+        self.offsets = offsets
+        self.stored = time.monotonic()
+        self.expires = self.stored + min(ttl for _, ttl in offsets)
+        self.qname = qname # qname / response / status are kept for logging hits without parsing anything
+        self.response = response
+        self.status = status
+        self.hits = 0
+        self.prefetched = False
+
+    def prefetch_due(self, now, fraction, min_hits):
+        # True once, for the hit that should get the answer refreshed before it expires (the engine rate limits it)
+        # hot names are answered from here and never reach the engine cache's own hit counting
+        window = max((self.expires - self.stored) * fraction, MIN_PREFETCH_WINDOW) # get() drops the entry in its last second
+        if self.prefetched or self.hits < min_hits or self.expires - now >= window:
+            return False
+        self.prefetched = True # a race lets two through at worst, the engine's single-flight joins them
+        return True
+
+class WireCache:
+    def __init__(self, capacity):
+        self.cache = OrderedDict()
+        self.capacity = capacity
+        self.lock = threading.Lock()
+
+    def get(self, data, pq, limit=512):
+        # (packed reply for this query, entry) or None, pq is the query_parser.ParsedQuery of data
+        # limit is the biggest reply the client can take, anything larger goes the slow way to get truncated
+        end = pq.q_end
+        if end is None:
+            return None
+        key = cache_key(data, pq)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if entry.expires - now < 1: # less than a second left, let the slow path refresh it
+                del self.cache[key]
+                return None
+            if len(entry.packet) > limit:
+                return None
+            self.cache.move_to_end(key)
+            entry.hits += 1
+        elapsed = int(now - entry.stored)
+        out = bytearray(entry.packet)
+        out[0:2] = data[0:2] # client's transaction id
+        out[2] = (out[2] & 0xFE) | (data[2] & 0x01) # echo rd
+        out[12:end] = data[12:end] # qname exactly as the client wrote it (0x20 case randomisation)
+        for off, ttl in entry.offsets:
+            struct.pack_into("!I", out, off, ttl - elapsed)
+        return out, entry
+
+    def put(self, data, pq, packet, qname, response, status="HIT"):
+        if pq.q_end is None or packet[2] & 0x02: # never keep truncated replies
+            return
+        key = cache_key(data, pq)
+        try:
+            offsets = ttl_offsets(packet)
+        except (IndexError, struct.error):
+            return
+        if not offsets or min(ttl for _, ttl in offsets) <= 1: # nothing to count down (or about to expire)
+            return
+        entry = WireEntry(bytes(packet), offsets, qname, response, status)
+        with self.lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
@@ -0,0 +1,61 @@
+import socket
+import time
+import multiprocessing
+from multiprocessing.managers import BaseManager
+# helpers for running a dns server as several pre-forked processes on the same ip:port
+# the kernel spreads incoming packets across the processes with SO_REUSEPORT
+
+class SharedCacheManager(BaseManager): # serves one cache object that every worker talks to through a proxy
+    pass
+
+def start_shared_cache(factory):
+    # factory builds the real cache inside the manager process, workers get a proxy with the same get/put methods
+    SharedCacheManager.register("Cache", callable=factory)
+    manager = SharedCacheManager()
+    manager.start()
+    return manager, manager.Cache()
+
+def reuseport_socket(ip, port, sock_type=socket.SOCK_DGRAM):
+    s = socket.socket(socket.AF_INET, sock_type)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # every worker binds the same port, kernel hashes clients onto them
+    s.bind((ip, port))
+    return s
+
+class WorkerStats: # one query counter per worker in shared memory
+    def __init__(self, n_workers):
+        self.counts = multiprocessing.Array('Q', n_workers, lock=False) # each slot only has one writer, no lock needed
+
+    def count(self, worker_id):
+        self.counts[worker_id] += 1
+
+    def snapshot(self):
+        return list(self.counts)
+
+def report_qps(stats, n_workers, interval):
+    # runs in the parent, prints per worker qps so we can check if scaling is linear
+    last = stats.snapshot()
+    while True:
+        time.sleep(interval)
+        now = stats.snapshot()
+        rates = [(now[i] - last[i]) / interval for i in range(n_workers)]
+        last = now
+        total = sum(rates)
+        per_worker = ", ".join(f"w{i}={r:.1f}" for i, r in enumerate(rates))
+        print(f"qps total={total:.1f} ({per_worker})")
+
+def run_workers(n_workers, target, interval=10):
+    # forks n_workers processes running target(worker_id, stats) and reports qps until interrupted
+    stats = WorkerStats(n_workers)
+    procs = []
+    for worker_id in range(n_workers):
+        p = multiprocessing.Process(target=target, args=(worker_id, stats), daemon=True)
+        p.start()
+        procs.append(p)
+    print(f"started {n_workers} workers: {', '.join(str(p.pid) for p in procs)}")
+    try:
+        report_qps(stats, n_workers, interval)
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.join()